@@ -0,0 +1,128 @@
+import importlib.util
+import json
+import os
+
+import numpy as np
+from ultralytics import YOLO
+
+# Inference backends and the ultralytics export format each of them runs
+BACKENDS = {
+    'pytorch': None,
+    'onnx': 'onnx',
+    'openvino': 'openvino',
+}
+
+# Packages each exported backend needs, see the optional section of requirements.txt
+BACKEND_PACKAGES = {
+    'onnx': ('onnx', 'onnxruntime'),
+    'openvino': ('openvino',),
+}
+
+
+def _source_stamp(model_path, imgsz):
+    stat = os.stat(model_path)
+    return {'source': os.path.realpath(model_path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'imgsz': imgsz}
+
+
+def _stamp_path(artifact_path):
+    return artifact_path.rstrip('/\\') + '.export.json'
+
+
+def export_model(model_path, backend, imgsz=640, force=False):
+    """Export the `.pt` weights for `backend` once and return the path of the exported model.
+
+    The exported model is written next to the weights by ultralytics. A small JSON stamp beside
+    it records which weights and image size it was built from, so it is rebuilt only when the
+    weights change.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {sorted(BACKENDS)}")
+    if BACKENDS[backend] is None:
+        return model_path
+
+    # Ultralytics would otherwise try to pip install them at run time, which fails offline
+    missing = [name for name in BACKEND_PACKAGES[backend] if importlib.util.find_spec(name) is None]
+    if missing:
+        raise ImportError(f"Backend '{backend}' needs {', '.join(missing)}, install the optional backend "
+                          f"packages of requirements.txt")
+
+    stamp = _source_stamp(model_path, imgsz)
+    stem = os.path.splitext(model_path)[0]
+    artifact_path = f"{stem}.onnx" if backend == 'onnx' else f"{stem}_openvino_model"
+    stamp_path = _stamp_path(artifact_path)
+    if not force and os.path.exists(artifact_path) and os.path.exists(stamp_path):
+        with open(stamp_path, 'r') as file:
+            if json.load(file) == stamp:
+                return artifact_path
+
+    # Dynamic axes let the exported model take batches of any size
+    artifact_path = str(YOLO(model_path).export(format=BACKENDS[backend], imgsz=imgsz, dynamic=True))
+    with open(_stamp_path(artifact_path), 'w') as file:
+        json.dump(stamp, file)
+    return artifact_path
+
+
+def load_model(model_path, backend='pytorch', task=None, imgsz=640):
+    """Load `model_path` to run on `backend`, exporting it first when needed."""
+    if backend == 'pytorch':
+        return YOLO(model_path, task=task)
+    # Exported models do not always carry their task, the fine-tuned models are segmentation models
+    return YOLO(export_model(model_path, backend, imgsz=imgsz), task=task or 'segment')
+
+
+def _box_iou(a, b):
+    # Pairwise IoU of two sets of xyxy boxes
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection + 1e-9)
+
+
+def compare_results(reference, candidate, box_tolerance=2.0, min_mask_iou=0.9):
+    """Check that two ultralytics results of the same image agree within a tolerance.
+
+    Instances are matched by class and highest box IoU.
+    :return: dict with the number of matched instances, the largest box coordinate difference in
+             pixels, the smallest mask IoU and whether everything is within tolerance.
+    """
+    def unpack(result):
+        if result.masks is None:
+            return np.zeros((0, 4)), np.zeros(0), None
+        return (result.boxes.xyxy.cpu().numpy(), result.boxes.cls.cpu().numpy(),
+                result.masks.data.cpu().numpy() > 0.5)
+
+    ref_boxes, ref_cls, ref_masks = unpack(reference)
+    cand_boxes, cand_cls, cand_masks = unpack(candidate)
+    report = {'reference': len(ref_cls), 'candidate': len(cand_cls), 'matched': 0,
+              'max_box_error': 0.0, 'min_mask_iou': 1.0}
+    if len(ref_cls) and len(cand_cls):
+        iou = _box_iou(ref_boxes, cand_boxes)
+        iou[ref_cls[:, None] != cand_cls[None, :]] = -1
+        for i in range(len(ref_cls)):
+            j = int(np.argmax(iou[i]))
+            if iou[i, j] <= 0:
+                continue
+            iou[:, j] = -1
+            report['matched'] += 1
+            report['max_box_error'] = max(report['max_box_error'],
+                                          float(np.abs(ref_boxes[i] - cand_boxes[j]).max()))
+            union = np.logical_or(ref_masks[i], cand_masks[j]).sum()
+            mask_iou = np.logical_and(ref_masks[i], cand_masks[j]).sum() / union if union else 1.0
+            report['min_mask_iou'] = min(report['min_mask_iou'], float(mask_iou))
+    report['ok'] = (report['matched'] == report['reference'] == report['candidate'] and
+                    report['max_box_error'] <= box_tolerance and report['min_mask_iou'] >= min_mask_iou)
+    return report
+
+
+def check_backend(model_path, backend, images, conf=0.1, box_tolerance=2.0, min_mask_iou=0.9, imgsz=640):
+    """Run `images` through the PyTorch model and `backend` and compare the results image by image."""
+    reference_model = load_model(model_path, 'pytorch')
+    candidate_model = load_model(model_path, backend, imgsz=imgsz)
+    reports = []
+    for image in images:
+        reference = reference_model(image, conf=conf, imgsz=imgsz, verbose=False)[0]
+        candidate = candidate_model(image, conf=conf, imgsz=imgsz, verbose=False)[0]
+        reports.append(compare_results(reference, candidate, box_tolerance, min_mask_iou))
+    return reports
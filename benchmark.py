@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Reproducible inference benchmark over synthetic_images_examples.
+
+Runs predict_on_images on the bundled example images and process_video on a synthetic video built
+from them, with the batching, pipeline, keyframe, ROI and backend settings given on the command
+line, and writes end-to-end FPS, latency percentiles and the time per stage (see stage_timing.py)
+as JSON so runs from different commits and settings can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from keyframes import KeyframeScheduler
+from model_cache import get_model
+from predict import collect_image_paths, predict_on_images, read_image
+from stage_timing import collect
+from video import process_video
+
+
+def benchmark_images(model_path, paths, conf, roi, repeat, warmup, batch_size, workers, backend):
+    """Run predict_on_images over the images `repeat` times, each pass into a new output directory."""
+    model = get_model(model_path, backend=backend)
+    for path in paths[:warmup]:
+        model(read_image(path), conf=conf, verbose=False)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, collect() as timer:
+        wall_start = time.perf_counter()
+        for index in range(repeat):
+            predict_on_images(paths, model_path, os.path.join(tmp_dir, str(index)), conf=conf,
+                              batch_size=batch_size, workers=workers, roi=roi, backend=backend)
+        wall_time = time.perf_counter() - wall_start
+    return timer.summary(wall_time)
+
+
+def build_synthetic_video(paths, video_path, frames, size, fps=30):
+    """Write a video that cycles through the example images, resized to `size`."""
+    out = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    images = [cv2.resize(read_image(path), size, interpolation=cv2.INTER_AREA) for path in paths]
+    for i in range(frames):
+        out.write(images[i % len(images)])
+    out.release()
+
+
+def benchmark_video(model_path, video_path, output_path, conf, roi, warmup, batch_size, pipelined, keyframes,
+                    backend):
+    """Run process_video on `video_path` with the given batching, pipeline and keyframe settings."""
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    model = get_model(model_path, backend=backend)
+    for _ in range(warmup):
+        model(np.zeros((height, width, 3), dtype=np.uint8), conf=conf, verbose=False)
+
+    with collect() as timer:
+        wall_start = time.perf_counter()
+        if keyframes:
+            # Keyframe mode runs frame by frame
+            process_video(video_path, output_path, model_path, conf=conf, roi=roi, keyframes=KeyframeScheduler(),
+                          backend=backend)
+        else:
+            process_video(video_path, output_path, model_path, conf=conf, batch_size=batch_size,
+                          pipelined=pipelined, roi=roi, backend=backend)
+        wall_time = time.perf_counter() - wall_start
+    return timer.summary(wall_time)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous_path):
+    """Print how FPS and p95 latency changed relative to an earlier results file."""
+    with open(previous_path, 'r') as file:
+        previous = json.load(file)
+    print(f"Compared with {previous_path} (commit {previous.get('commit')}):")
+    for name in ('images', 'video'):
+        if name not in current or name not in previous:
+            continue
+        old, new = previous[name], current[name]
+        change = f"{(new['fps'] / old['fps'] - 1) * 100:+.1f}%" if old['fps'] > 0 else "n/a"
+        print(f"  {name:<6} FPS {old['fps']:8.2f} -> {new['fps']:8.2f} ({change})"
+              f"  p95 {old['latency_ms']['p95']:8.2f} -> {new['latency_ms']['p95']:8.2f} ms")
+
+
+def print_summary(name, summary):
+    latency = summary['latency_ms']
+    print(f"{name}: {summary['frames']} frames, {summary['fps']:.2f} FPS, "
+          f"latency p50 {latency['p50']:.1f} / p95 {latency['p95']:.1f} / p99 {latency['p99']:.1f} ms")
+    for stage, ms in summary['stages_ms_per_frame'].items():
+        print(f"  {stage:<16} {ms:8.2f} ms/frame")
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", default="yolov8_20_epochs_fine_tune.pt", type=str,
+                        help="Path to the YOLO weights. Default: 'yolov8_20_epochs_fine_tune.pt'.")
+    parser.add_argument("-i", "--images", default=os.path.join("synthetic_images_examples", "images"), type=str,
+                        help="Directory of benchmark images. Default: 'synthetic_images_examples/images'.")
+    parser.add_argument("--backend", default="pytorch", type=str, help="Inference backend. Default: 'pytorch'.")
+    parser.add_argument("--conf", default=0.1, type=float, help="Confidence threshold. Default: 0.1.")
+    parser.add_argument("--roi", action="store_true", help="Blend masks only inside their boxes.")
+    parser.add_argument("-b", "--batch-size", default=8, type=int,
+                        help="Images or frames sent to the model in one call. Default: 8.")
+    parser.add_argument("--workers", default=4, type=int, help="Threads decoding and writing images. Default: 4.")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Decode, segment and encode the video on separate threads.")
+    parser.add_argument("--keyframes", action="store_true",
+                        help="Run the model only on video keyframes and track the detections in between; the "
+                             "video then runs frame by frame, without --batch-size and --pipelined.")
+    parser.add_argument("--repeat", default=3, type=int, help="Passes over the images. Default: 3.")
+    parser.add_argument("--warmup", default=2, type=int, help="Untimed warmup inferences. Default: 2.")
+    parser.add_argument("--video-frames", default=150, type=int,
+                        help="Frames in the synthetic video, 0 to skip it. Default: 150.")
+    parser.add_argument("--video-size", default=(1920, 1080), type=int, nargs=2,
+                        help="Width and height of the synthetic video. Default: 1920 1080.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", type=str,
+                        help="Output JSON file. Default: 'benchmark_results.json'.")
+    parser.add_argument("--compare", type=str, help="Earlier results file to compare against.")
+    args = parser.parse_args()
+
+    paths = collect_image_paths(args.images)
+    if not paths:
+        raise FileNotFoundError(f"No images found in {args.images}")
+
+    results = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+    }
+    results['images'] = benchmark_images(args.model, paths, args.conf, args.roi, args.repeat, args.warmup,
+                                         args.batch_size, args.workers, args.backend)
+    print_summary('images', results['images'])
+
+    if args.video_frames > 0:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            video_path = os.path.join(tmp_dir, 'synthetic.mp4')
+            build_synthetic_video(paths, video_path, args.video_frames, tuple(args.video_size))
+            results['video'] = benchmark_video(args.model, video_path, os.path.join(tmp_dir, 'output.mp4'),
+                                               args.conf, args.roi, args.warmup, args.batch_size, args.pipelined,
+                                               args.keyframes, args.backend)
+        print_summary('video', results['video'])
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=4)
+    print(f"Results saved at {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
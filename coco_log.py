@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Line-oriented log of COCO annotations, built into one COCO file at the end of a run.
+
+BlenderProc's `write_coco_annotations(..., append_to_existing_output=True)` reads and rewrites the
+whole coco_annotations.json for every frame. The generators instead append to `annotations.jsonl`
+one JSON line per frame (the image record and its annotations), a header line with the COCO info
+and licenses, and a line per new set of categories, and build coco_annotations.json from it once.
+Every line is flushed and synced when written, so after a crash the log holds every finished
+frame; a torn last line is ignored.
+
+    python coco_log.py output/coco_data/annotations.jsonl output/coco_data/coco_annotations.json
+"""
+
+import argparse
+import json
+import os
+
+LOG_NAME = 'annotations.jsonl'
+
+
+def read_coco_log(path):
+    """Return (header, images, annotations, categories) of the log at `path`, skipping a torn last line.
+
+    The header holds the `info` and `licenses` of the COCO file, it is empty if none was logged.
+    """
+    header, images, annotations, categories = {}, [], [], {}
+    if not os.path.exists(path):
+        return header, images, annotations, []
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line can be torn, by a crash while it was written
+                break
+            if 'info' in record:
+                header = record
+            for category in record.get('categories', []):
+                categories.setdefault(category['id'], category)
+            if 'image' in record:
+                images.append(record['image'])
+                annotations.extend(record['annotations'])
+    return header, images, annotations, [categories[key] for key in sorted(categories)]
+
+
+def truncate_log(path, num_images):
+    """Drop the frames of images with an id from `num_images` on, e.g. those rendered after the last
+    checkpoint of an interrupted run. Written atomically."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as file:
+        lines = file.readlines()
+    kept = []
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            break
+        if 'image' not in record or record['image']['id'] < num_images:
+            kept.append(line)
+    with open(path + '.partial', 'w') as file:
+        file.writelines(kept)
+    os.replace(path + '.partial', path)
+
+
+class CocoLogWriter:
+    """Appends frames to a COCO log, numbering images and annotations after those already in it."""
+
+    def __init__(self, path):
+        self.path = path
+        header, images, annotations, categories = read_coco_log(path)
+        self.has_header = bool(header)
+        self.next_image_id = max((image['id'] for image in images), default=-1) + 1
+        self.next_annotation_id = max((annotation['id'] for annotation in annotations), default=-1) + 1
+        self.categories = {category['id'] for category in categories}
+        self._truncate_torn_line()
+        self._file = open(path, 'a')
+
+    def _truncate_torn_line(self):
+        # Drop a line left unfinished by a crash, so new lines do not get appended to it
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as file:
+            data = file.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                file.truncate(end)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def write_header(self, info, licenses=()):
+        self._write({'info': info, 'licenses': list(licenses)})
+        self.has_header = True
+
+    def write_frame(self, image, annotations, categories=()):
+        """Log one frame. `image` and `annotations` get the next ids, the image id of the annotations
+        is set to the image's. Categories not logged before are logged first.
+
+        :return: the id of the image.
+        """
+        new_categories = [category for category in categories if category['id'] not in self.categories]
+        if new_categories:
+            self._write({'categories': new_categories})
+            self.categories.update(category['id'] for category in new_categories)
+        image = dict(image, id=self.next_image_id)
+        annotations = [dict(annotation, id=self.next_annotation_id + i, image_id=image['id'])
+                       for i, annotation in enumerate(annotations)]
+        self._write({'image': image, 'annotations': annotations})
+        self.next_image_id += 1
+        self.next_annotation_id += len(annotations)
+        return image['id']
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build_coco(log_path, output_path):
+    """Write the COCO file of the log at `log_path` to `output_path`, atomically.
+
+    :return: (number of images, number of annotations).
+    """
+    header, images, annotations, categories = read_coco_log(log_path)
+    coco = {'info': header.get('info', {}), 'licenses': header.get('licenses', []), 'categories': categories,
+            'images': images, 'annotations': annotations}
+    with open(output_path + '.partial', 'w') as file:
+        json.dump(coco, file)
+    os.replace(output_path + '.partial', output_path)
+    return len(images), len(annotations)
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser(description="Build a COCO file from an annotations.jsonl log.")
+    parser.add_argument("log", type=str, help="annotations.jsonl written by a generator.")
+    parser.add_argument("output", type=str, help="COCO JSON file to write.")
+    args = parser.parse_args()
+
+    images, annotations = build_coco(args.log, args.output)
+    print(f"Wrote {images} images and {annotations} annotations to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
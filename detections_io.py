@@ -0,0 +1,221 @@
+import io
+import json
+import os
+import struct
+from bisect import bisect_right
+
+import numpy as np
+
+from keyframes import Detections
+
+# File layout:
+#   MAGIC
+#   chunk*     CHUNK_HEADER (b'CHNK', first frame, number of frames, payload length) + payload
+#   index      INDEX_HEADER (b'INDX', length) + JSON list of [first frame, frames, offset, length]
+#   footer     FOOTER (index offset, END_MAGIC)
+# Every chunk is self-describing, so a file whose writer never closed it can still be read by
+# scanning the chunk headers.
+MAGIC = b'DETS0001'
+END_MAGIC = b'DETSEND1'
+CHUNK_HEADER = struct.Struct('<4sIII')
+INDEX_HEADER = struct.Struct('<4sI')
+FOOTER = struct.Struct('<Q8s')
+
+
+def rle_encode(mask):
+    """Run-length encode a binary mask as COCO-style uncompressed counts (column-major, zeros first)."""
+    flat = np.asarray(mask, dtype=bool).ravel(order='F')
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.uint32)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.uint32)
+
+
+def rle_decode(counts, shape):
+    """Inverse of rle_encode."""
+    values = (np.arange(len(counts)) % 2).astype(bool)
+    return np.repeat(values, counts).reshape(shape, order='F')
+
+
+class DetectionWriter:
+    """Streams per-frame classes, confidences, boxes and RLE masks to a compact chunked file.
+
+    Frames are buffered and written as one compressed chunk every `chunk_size` frames, so memory
+    stays bounded on long videos.
+    """
+
+    def __init__(self, path, chunk_size=64, frame_shape=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.frame_shape = frame_shape
+        self.frames = 0
+        self._buffer = []
+        self._index = []
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, detections, frame_index=None):
+        """Append the detections of one frame. Frames are numbered consecutively by default."""
+        if frame_index is None:
+            frame_index = self.frames
+        self._buffer.append((frame_index, detections))
+        self.frames = frame_index + 1
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered frames as one chunk."""
+        if not self._buffer:
+            return
+        frame_indices, class_ids, confidences, boxes = [], [], [], []
+        instance_offsets, mask_shapes, rle_offsets, rle_counts = [0], [], [0], []
+        for frame_index, detections in self._buffer:
+            frame_indices.append(frame_index)
+            instance_offsets.append(instance_offsets[-1] + len(detections))
+            class_ids.extend(np.asarray(detections.class_ids).reshape(-1))
+            confidences.extend(np.asarray(detections.confidences).reshape(-1))
+            boxes.extend(np.asarray(detections.boxes).reshape(-1, 4))
+            for mask in detections.masks:
+                counts = rle_encode(mask)
+                mask_shapes.append(mask.shape)
+                rle_counts.append(counts)
+                rle_offsets.append(rle_offsets[-1] + len(counts))
+
+        payload = io.BytesIO()
+        np.savez_compressed(
+            payload,
+            frame_indices=np.asarray(frame_indices, dtype=np.uint32),
+            instance_offsets=np.asarray(instance_offsets, dtype=np.uint32),
+            class_ids=np.asarray(class_ids, dtype=np.uint16),
+            confidences=np.asarray(confidences, dtype=np.float32),
+            boxes=np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+            mask_shapes=np.asarray(mask_shapes, dtype=np.uint32).reshape(-1, 2),
+            rle_offsets=np.asarray(rle_offsets, dtype=np.uint64),
+            rle_counts=np.concatenate(rle_counts) if rle_counts else np.zeros(0, dtype=np.uint32))
+        payload = payload.getvalue()
+
+        offset = self._file.tell()
+        self._file.write(CHUNK_HEADER.pack(b'CHNK', frame_indices[0], len(frame_indices), len(payload)))
+        self._file.write(payload)
+        self._index.append([frame_indices[0], len(frame_indices), offset, CHUNK_HEADER.size + len(payload)])
+        self._buffer = []
+
+    def close(self):
+        """Write the remaining frames, the chunk index and the footer."""
+        if self._file.closed:
+            return
+        self.flush()
+        index_offset = self._file.tell()
+        index = json.dumps({'chunks': self._index, 'frames': self.frames,
+                            'frame_shape': self.frame_shape}).encode()
+        self._file.write(INDEX_HEADER.pack(b'INDX', len(index)))
+        self._file.write(index)
+        self._file.write(FOOTER.pack(index_offset, END_MAGIC))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DetectionReader:
+    """Random access to a file written by DetectionWriter, loading only the chunks it needs."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a detections file")
+        self.frame_shape = None
+        self.chunks = self._read_index()
+        if self.chunks is None:
+            # The writer did not finish; recover the index from the chunk headers
+            self.chunks = self._scan_chunks()
+        self._starts = [chunk[0] for chunk in self.chunks]
+        self._cache = (None, None)
+
+    def _read_index(self):
+        size = os.path.getsize(self.path)
+        if size < len(MAGIC) + FOOTER.size:
+            return None
+        self._file.seek(size - FOOTER.size)
+        index_offset, end_magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if end_magic != END_MAGIC:
+            return None
+        self._file.seek(index_offset)
+        tag, length = INDEX_HEADER.unpack(self._file.read(INDEX_HEADER.size))
+        if tag != b'INDX':
+            return None
+        index = json.loads(self._file.read(length))
+        self.frame_shape = index.get('frame_shape')
+        return index['chunks']
+
+    def _scan_chunks(self):
+        chunks = []
+        offset = len(MAGIC)
+        size = os.path.getsize(self.path)
+        while offset + CHUNK_HEADER.size <= size:
+            self._file.seek(offset)
+            tag, first_frame, frames, length = CHUNK_HEADER.unpack(self._file.read(CHUNK_HEADER.size))
+            if tag != b'CHNK' or offset + CHUNK_HEADER.size + length > size:
+                break
+            chunks.append([first_frame, frames, offset, CHUNK_HEADER.size + length])
+            offset += CHUNK_HEADER.size + length
+        return chunks
+
+    def __len__(self):
+        if not self.chunks:
+            return 0
+        first_frame, frames, _, _ = self.chunks[-1]
+        return first_frame + frames
+
+    def _load_chunk(self, position):
+        if self._cache[0] == position:
+            return self._cache[1]
+        _, _, offset, length = self.chunks[position]
+        self._file.seek(offset + CHUNK_HEADER.size)
+        with np.load(io.BytesIO(self._file.read(length - CHUNK_HEADER.size))) as data:
+            chunk = {key: data[key] for key in data.files}
+        self._cache = (position, chunk)
+        return chunk
+
+    @staticmethod
+    def _frame(chunk, row):
+        first, last = chunk['instance_offsets'][row:row + 2]
+        masks = [rle_decode(chunk['rle_counts'][chunk['rle_offsets'][i]:chunk['rle_offsets'][i + 1]],
+                            tuple(chunk['mask_shapes'][i]))
+                 for i in range(first, last)]
+        masks = np.stack(masks).astype(np.uint8) if masks else np.zeros((0, 0, 0), dtype=np.uint8)
+        return Detections(masks, chunk['class_ids'][first:last], chunk['confidences'][first:last],
+                          chunk['boxes'][first:last])
+
+    def read(self, start, stop=None):
+        """Yield (frame index, Detections) for the frames in [start, stop)."""
+        if stop is None:
+            stop = len(self)
+        position = max(bisect_right(self._starts, start) - 1, 0)
+        while position < len(self.chunks) and self.chunks[position][0] < stop:
+            chunk = self._load_chunk(position)
+            for row, frame_index in enumerate(chunk['frame_indices']):
+                if start <= frame_index < stop:
+                    yield int(frame_index), self._frame(chunk, row)
+            position += 1
+
+    def __getitem__(self, frame_index):
+        for index, detections in self.read(frame_index, frame_index + 1):
+            return detections
+        raise IndexError(frame_index)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
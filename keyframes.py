@@ -0,0 +1,150 @@
+import cv2
+import numpy as np
+
+
+class Detections:
+    """Masks, classes, confidences and boxes of the instances found in one frame."""
+
+    def __init__(self, masks, class_ids, confidences, boxes):
+        self.masks = masks
+        self.class_ids = class_ids
+        self.confidences = confidences
+        self.boxes = boxes
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    @classmethod
+    def from_result(cls, result, frame_shape):
+        """Build detections from one ultralytics result."""
+        if result.masks is None:
+            return cls(np.zeros((0,) + tuple(frame_shape[:2]), dtype=np.uint8),
+                       np.zeros(0), np.zeros(0), np.zeros((0, 4)))
+        boxes = result.boxes
+        return cls((result.masks.data.cpu().numpy() != 0).astype(np.uint8),
+                   boxes.cls.cpu().numpy(),
+                   boxes.conf.cpu().numpy(),
+                   boxes.xyxy.cpu().numpy())
+
+
+class KeyframeScheduler:
+    """Decides which frames run the segmentation model and propagates detections in between.
+
+    On a keyframe, up to `max_points` corners are picked inside every instance box on a downscaled
+    grayscale frame. On the following frames the corners are tracked with pyramidal Lucas-Kanade
+    optical flow and the median displacement of each instance moves its box and mask. A new
+    keyframe is forced when:
+
+    - `max_interval` frames have passed since the last keyframe,
+    - an instance moved more than `motion_threshold` pixels since the last keyframe,
+    - the fraction of an instance's corners that are still tracked drops below `min_track_ratio`,
+      or its propagated confidence (keyframe confidence times that fraction) drops below
+      `min_confidence`,
+    - the mean absolute difference to the keyframe exceeds `scene_threshold` gray levels, which
+      also catches instruments entering a frame that had no detections.
+    """
+
+    def __init__(self, max_interval=5, motion_threshold=12.0, min_track_ratio=0.5, min_confidence=0.0,
+                 scene_threshold=12.0, scale=0.25, max_points=20):
+        self.max_interval = max_interval
+        self.motion_threshold = motion_threshold
+        self.min_track_ratio = min_track_ratio
+        self.min_confidence = min_confidence
+        self.scene_threshold = scene_threshold
+        self.scale = scale
+        self.max_points = max_points
+        self.keyframes = 0
+        self.frames = 0
+        self._keyframe = None
+
+    def _small_gray(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def set_keyframe(self, frame, detections):
+        """Remember `detections` of a frame that went through the model and pick points to track."""
+        small = self._small_gray(frame)
+        points, owners = [], []
+        for i, box in enumerate(detections.boxes):
+            x1, y1, x2, y2 = np.clip(np.asarray(box) * self.scale, 0, [small.shape[1] - 1, small.shape[0] - 1] * 2)
+            region = np.zeros_like(small)
+            region[int(y1):int(y2) + 1, int(x1):int(x2) + 1] = 255
+            corners = cv2.goodFeaturesToTrack(small, self.max_points, 0.01, 3, mask=region)
+            if corners is None:
+                continue
+            points.append(corners.reshape(-1, 2))
+            owners.append(np.full(len(corners), i))
+
+        owners = np.concatenate(owners) if owners else np.zeros(0, dtype=np.intp)
+        self._keyframe = {
+            'detections': detections,
+            'gray': small,
+            'prev_gray': small,
+            'points': np.concatenate(points).astype(np.float32) if points else np.zeros((0, 2), np.float32),
+            'owners': owners,
+            'initial': np.bincount(owners, minlength=len(detections)),
+            'offsets': np.zeros((len(detections), 2)),
+            'age': 0,
+            'frame_shape': frame.shape[:2],
+        }
+        self.keyframes += 1
+        self.frames += 1
+
+    def propagate(self, frame):
+        """Return detections moved onto `frame`, or None when the frame has to be a keyframe."""
+        key = self._keyframe
+        if key is None or key['age'] + 1 >= self.max_interval or frame.shape[:2] != key['frame_shape']:
+            return None
+
+        small = self._small_gray(frame)
+        if cv2.absdiff(small, key['gray']).mean() > self.scene_threshold:
+            return None
+
+        detections = key['detections']
+        n = len(detections)
+        offsets = key['offsets'].copy()
+        confidences = np.asarray(detections.confidences, dtype=np.float64).copy()
+        points, owners = key['points'], key['owners']
+        if n:
+            if len(points) == 0:
+                return None
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(key['prev_gray'], small, points.reshape(-1, 1, 2), None)
+            tracked = status.reshape(-1) == 1
+            moved = moved.reshape(-1, 2)
+            for i in range(n):
+                own = owners == i
+                good = own & tracked
+                if key['initial'][i] == 0 or not good.any():
+                    return None
+                ratio = np.count_nonzero(good) / key['initial'][i]
+                if ratio < self.min_track_ratio:
+                    return None
+                confidences[i] *= ratio
+                offsets[i] += np.median(moved[good] - points[good], axis=0) / self.scale
+            if (confidences < self.min_confidence).any():
+                return None
+            if (np.linalg.norm(offsets, axis=1) > self.motion_threshold).any():
+                return None
+            points, owners = moved[tracked], owners[tracked]
+
+        key.update(prev_gray=small, points=points, owners=owners, offsets=offsets, age=key['age'] + 1)
+        self.frames += 1
+        return self._shifted(detections, offsets, confidences, frame.shape[:2])
+
+    @staticmethod
+    def _shifted(detections, offsets, confidences, frame_shape):
+        # Move every mask and box by its accumulated offset since the keyframe
+        height, width = frame_shape
+        masks = np.empty_like(detections.masks)
+        mask_h, mask_w = detections.masks.shape[1:]
+        for i, (dx, dy) in enumerate(offsets):
+            shift = np.float32([[1, 0, dx * mask_w / width], [0, 1, dy * mask_h / height]])
+            masks[i] = cv2.warpAffine(detections.masks[i], shift, (mask_w, mask_h), flags=cv2.INTER_NEAREST)
+        boxes = np.asarray(detections.boxes, dtype=np.float64) + np.tile(offsets, 2)
+        return Detections(masks, detections.class_ids, confidences, boxes)
+
+    def report(self):
+        """Print how many frames went through the model."""
+        if self.frames:
+            print(f"Keyframes: {self.keyframes}/{self.frames} frames "
+                  f"({self.keyframes / self.frames:.1%} ran the segmentation model)")
@@ -0,0 +1,76 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from backends import load_model
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded YOLO models with least-recently-used eviction.
+
+    Models are keyed by the resolved weights path, its modification time and the settings they
+    were created with (task, device and inference backend), so a retrained checkpoint written to
+    the same path is loaded again.
+    """
+
+    def __init__(self, max_models=2):
+        self.max_models = max_models
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model_path, task=None, device=None, backend='pytorch'):
+        path = os.path.realpath(model_path)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        return path, mtime, task, None if device is None else str(device), backend
+
+    def get(self, model_path, task=None, device=None, backend='pytorch'):
+        """Return the cached model for `model_path` and settings, loading it on first use."""
+        key = self._key(model_path, task, device, backend)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+            # Load the model, exporting it for the requested backend when needed
+            model = load_model(model_path, backend=backend, task=task)
+            if device is not None and backend == 'pytorch':
+                model.to(device)
+            self._models[key] = model
+
+            # Evict the least recently used models
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+            return model
+
+    def warmup(self, model_path, task=None, device=None, backend='pytorch', imgsz=640, **predict_kwargs):
+        """Load the model and run one dummy inference so later calls skip the setup cost."""
+        model = self.get(model_path, task=task, device=device, backend=backend)
+        dummy = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+        model(dummy, imgsz=imgsz, verbose=False, **predict_kwargs)
+        return model
+
+    def evict(self, model_path, task=None, device=None, backend='pytorch'):
+        """Drop one model from the cache."""
+        with self._lock:
+            self._models.pop(self._key(model_path, task, device, backend), None)
+
+    def clear(self):
+        """Drop every cached model."""
+        with self._lock:
+            self._models.clear()
+
+    def __len__(self):
+        return len(self._models)
+
+
+# Registry shared by predict_on_image and process_video when no other registry is given
+default_registry = ModelRegistry()
+
+
+def get_model(model_path, registry=None, **settings):
+    """Return a cached model from `registry`, or from the process-wide default registry."""
+    if registry is None:
+        registry = default_registry
+    return registry.get(model_path, **settings)
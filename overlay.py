@@ -0,0 +1,275 @@
+import cv2
+import numpy as np
+
+from stage_timing import stage
+
+# Define colors for each category (in BGR format)
+DEFAULT_COLORS = {
+    'Tweezers': (0, 255, 0),   # Green
+    'Needle_driver': (0, 0, 255)  # Red
+}
+FALLBACK_COLOR = (255, 255, 255)
+
+# Blend tables keyed by (channel value, alpha), grown on demand
+_blend_luts = {}
+
+
+def _blend_lut(value, alpha, depth):
+    """Return a (depth + 1, 256) table where row n is a pixel value blended n times with `value`.
+
+    The rows are produced with cv2.addWeighted itself so that rounding and saturation match
+    the per-instance blending done by the original scripts bit for bit.
+    """
+    key = (value, alpha)
+    lut = _blend_luts.get(key)
+    if lut is None or lut.shape[0] <= depth:
+        rows = max(depth + 1, 8)
+        lut = np.empty((rows, 256), dtype=np.uint8)
+        lut[0] = np.arange(256, dtype=np.uint8)
+        add = np.full((1, 256), value, dtype=np.uint8)
+        for n in range(1, rows):
+            lut[n] = cv2.addWeighted(lut[n - 1:n], 1, add, alpha, 0)
+        _blend_luts[key] = lut
+    return lut
+
+
+def nearest_indices(src_size, dst_size, start=0, stop=None):
+    """Source indices that cv2.INTER_NEAREST samples for destination positions [start, stop)."""
+    if stop is None:
+        stop = dst_size
+    inv_scale = 1.0 / (dst_size / src_size)
+    idx = np.floor(np.arange(start, stop) * inv_scale).astype(np.intp)
+    return np.minimum(idx, src_size - 1)
+
+
+def _annotation_roi(box, label, shape):
+    """Conservative (y1, y2, x1, x2) window that contains the box and label drawn for one instance."""
+    x1, y1, x2, y2 = box
+    (text_w, text_h), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)
+    pad = 4
+    left = min(x1, x2) - pad
+    right = max(x1 + text_w, x2) + pad
+    top = min(y1 - 10 - text_h, y2) - pad
+    bottom = max(y1 - 10 + baseline, y2, y1) + pad
+    return (max(top, 0), min(bottom + 1, shape[0]), max(left, 0), min(right + 1, shape[1]))
+
+
+def _box_windows(boxes, shape):
+    """(N, 4) array of (top, bottom, left, right) pixel windows covered by each xyxy box."""
+    windows = np.empty((len(boxes), 4), dtype=np.intp)
+    for i, box in enumerate(boxes):
+        x1, y1, x2, y2 = map(int, box)
+        top, bottom = np.clip((min(y1, y2), max(y1, y2) + 1), 0, shape[0])
+        left, right = np.clip((min(x1, x2), max(x1, x2) + 1), 0, shape[1])
+        windows[i] = (top, bottom, left, right)
+    return windows
+
+
+class LabelCodec:
+    """Encodes per-color instance counts into a single label and maps labels to blended colors.
+
+    A label is the mixed-radix number formed by how many instances of each palette color cover
+    a pixel, so one label map describes every mask at once. The lookup table row for a label
+    holds, for every input value and channel, the result of blending that many instances of each
+    color in turn. Channels whose color value is zero are left untouched, exactly as adding a
+    zero color mask would. The result is identical to sequential blending whenever each channel
+    uses a single non-zero intensity across the palette, which holds for the default colors.
+    """
+
+    def __init__(self, palette, depths, alpha=0.5):
+        self.palette = palette
+        self.depths = depths
+        self.strides = []
+        stride = 1
+        for depth in depths:
+            self.strides.append(stride)
+            stride *= depth + 1
+        self.num_labels = stride
+        self.dtype = np.uint16 if stride <= np.iinfo(np.uint16).max + 1 else np.int32
+        self.alpha = alpha
+        self._table = None
+
+    def encode(self, counts):
+        """Combine a list of per-color count arrays into one label array."""
+        labels = np.zeros(counts[0].shape, dtype=self.dtype)
+        for count, stride in zip(counts, self.strides):
+            labels += count.astype(self.dtype) * self.dtype(stride)
+        return labels
+
+    @property
+    def table(self):
+        """(num_labels, 256, 3) color lookup table."""
+        if self._table is None:
+            identity = np.arange(256, dtype=np.uint8)
+            table = np.empty((self.num_labels, 256, 3), dtype=np.uint8)
+            luts = [[_blend_lut(value, self.alpha, depth) if value else None for value in color]
+                    for color, depth in zip(self.palette, self.depths)]
+            for label in range(self.num_labels):
+                for channel in range(3):
+                    row = identity
+                    for color_luts, stride, depth in zip(luts, self.strides, self.depths):
+                        count = (label // stride) % (depth + 1)
+                        if count and color_luts[channel] is not None:
+                            row = color_luts[channel][count][row]
+                    table[label, :, channel] = row
+            self._table = table
+        return self._table
+
+    def blend(self, image, selected, label):
+        """Blend a contiguous (H, W, 3) `image` in place as `label` wherever `selected` is non-zero."""
+        blended = cv2.LUT(image, self.table[label].reshape(256, 1, 3))
+        cv2.copyTo(blended, selected, image)
+        return image
+
+    def apply(self, pixels, labels):
+        """Blend (P, 3) `pixels` according to their (P,) `labels`."""
+        return self.table[labels[:, None], pixels, np.arange(3)]
+
+
+def draw_instances(image, masks, class_ids, confidences, boxes, names, colors=None, alpha=0.5, roi=False):
+    """Draw instance masks, boxes and labels onto a BGR image in a single blending pass.
+
+    :param image: BGR uint8 image of shape (H, W, 3). It is not modified.
+    :param masks: (N, h, w) array of instance masks at any resolution.
+    :param class_ids: N class indices into `names`.
+    :param confidences: N confidence scores.
+    :param boxes: (N, 4) xyxy boxes in image coordinates.
+    :param names: mapping from class index to category name.
+    :param colors: mapping from category name to BGR color. Default: DEFAULT_COLORS.
+    :param alpha: weight of the color mask when blending.
+    :param roi: upsample and blend each mask only inside its bounding box, sampling the masks at
+                the resolution the model produced them. Mask pixels outside the box are dropped.
+    :return: a new image identical to blending and annotating each instance in turn.
+    """
+    if colors is None:
+        colors = DEFAULT_COLORS
+    output = image.copy()
+    n = len(masks)
+    if n == 0:
+        return output
+    height, width = image.shape[:2]
+
+    instance_colors = [tuple(colors.get(names[int(c)], FALLBACK_COLOR)) for c in class_ids]
+    palette = list(dict.fromkeys(instance_colors))
+    color_index = np.array([palette.index(color) for color in instance_colors])
+
+    # Upsample the masks into (codec, label, window, selected pixels) regions to blend
+    with stage('mask_processing'):
+        masks = (np.asarray(masks) != 0).astype(np.uint8)
+        mask_h, mask_w = masks.shape[1:]
+
+        rows = nearest_indices(mask_h, height)
+        cols = nearest_indices(mask_w, width)
+        windows = _box_windows(boxes, (height, width)) if roi else None
+
+        regions = []
+        if roi:
+            # Sample each mask only inside its box, the instances are blended one after another there
+            for i, (top, bottom, left, right) in enumerate(windows):
+                if top >= bottom or left >= right:
+                    continue
+                selected = np.take(np.take(masks[i], rows[top:bottom], axis=0), cols[left:right], axis=1)
+                regions.append((LabelCodec([instance_colors[i]], [1], alpha), 1, (top, bottom, left, right), selected))
+        else:
+            # Nearest-neighbour upsampling is a pure gather, so the label map can be built at mask
+            # resolution and upsampled once instead of resizing every mask to the full frame
+            low_res_counts = [masks[color_index == p].sum(axis=0, dtype=np.uint8) for p in range(len(palette))]
+            codec = LabelCodec(palette, [int(count.max()) for count in low_res_counts], alpha)
+            low_res_labels = codec.encode(low_res_counts)
+
+            # Every covered pixel is blended in one vectorized pass through the lookup table, each
+            # label only inside the window where it occurs
+            covered = np.flatnonzero(low_res_labels)
+            for label in np.unique(low_res_labels.ravel()[covered]):
+                selected = (low_res_labels == label).view(np.uint8)
+                label_y, label_x = np.nonzero(selected)
+                top = np.searchsorted(rows, label_y.min())
+                bottom = np.searchsorted(rows, label_y.max(), side='right')
+                left = np.searchsorted(cols, label_x.min())
+                right = np.searchsorted(cols, label_x.max(), side='right')
+                if top >= bottom or left >= right:
+                    continue
+                selected = np.take(np.take(selected, rows[top:bottom], axis=0), cols[left:right], axis=1)
+                regions.append((codec, label, (top, bottom, left, right), selected))
+
+    with stage('overlay'):
+        _blend_regions(output, regions)
+        _annotate(output, masks, rows, cols, windows, class_ids, confidences, boxes, names, instance_colors,
+                  palette, color_index, alpha)
+    return output
+
+
+def _blend_regions(output, regions):
+    for codec, label, (top, bottom, left, right), selected in regions:
+        region = np.ascontiguousarray(output[top:bottom, left:right])
+        codec.blend(region, selected, label)
+        output[top:bottom, left:right] = region
+
+
+def _annotate(output, masks, rows, cols, windows, class_ids, confidences, boxes, names, instance_colors, palette,
+              color_index, alpha):
+    # Blend boxes and labels over `output`, under the masks of the instances drawn after them
+    n = len(masks)
+    height, width = output.shape[:2]
+    roi = windows is not None
+
+    # Draw boxes and labels, remembering which pixels each instance painted
+    scratch = np.zeros((height, width), dtype=np.uint8)
+    painted_y, painted_x, painted_by = [], [], []
+    for i in range(n):
+        x1, y1, x2, y2 = map(int, boxes[i])
+        label = f"{names[int(class_ids[i])]} {float(confidences[i]):.2f}"
+        cv2.rectangle(scratch, (x1, y1), (x2, y2), 1, 2)
+        cv2.putText(scratch, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1, 2)
+        top, bottom, left, right = _annotation_roi((x1, y1, x2, y2), label, scratch.shape)
+        if top >= bottom or left >= right:
+            continue
+        window = scratch[top:bottom, left:right]
+        points = cv2.findNonZero(window)
+        if points is None:
+            continue
+        painted_x.append(points[:, 0, 0] + left)
+        painted_y.append(points[:, 0, 1] + top)
+        painted_by.append(np.full(len(points), i))
+        window[:] = 0
+
+    if painted_y:
+        ys = np.concatenate(painted_y)
+        xs = np.concatenate(painted_x)
+        painter = np.concatenate(painted_by)
+        # Keep the instance that painted each pixel last
+        flat = ys * width + xs
+        _, last = np.unique(flat[::-1], return_index=True)
+        keep = len(flat) - 1 - last
+        ys, xs, painter = ys[keep], xs[keep], painter[keep]
+
+        # Instances drawn later were still blended over earlier boxes and labels
+        covered = masks[:, rows[ys], cols[xs]].T > 0
+        if roi:
+            covered &= ((ys[:, None] >= windows[None, :, 0]) & (ys[:, None] < windows[None, :, 1]) &
+                        (xs[:, None] >= windows[None, :, 2]) & (xs[:, None] < windows[None, :, 3]))
+        later = covered & (np.arange(n)[None, :] > painter[:, None])
+        later_counts = [np.count_nonzero(later[:, color_index == p], axis=1).astype(np.uint8)
+                        for p in range(len(palette))]
+        codec = LabelCodec(palette, [int(count.max()) for count in later_counts], alpha)
+        annotated = np.array(instance_colors, dtype=np.uint8)[painter]
+        output[ys, xs] = codec.apply(annotated, codec.encode(later_counts))
+
+
+def draw_results(image, results, names, colors=None, alpha=0.5, roi=False):
+    """Draw every ultralytics result in `results` onto `image` and return the new image."""
+    for result in results:
+        masks = result.masks
+        boxes = result.boxes
+
+        if masks is not None:
+            with stage('mask_processing'):
+                instances = (masks.data.cpu().numpy(), boxes.cls.cpu().numpy(), boxes.conf.cpu().numpy(),
+                             boxes.xyxy.cpu().numpy())
+            image = draw_instances(image,
+                                   *instances,
+                                   names,
+                                   colors=colors,
+                                   alpha=alpha,
+                                   roi=roi)
+    return image
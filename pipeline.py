@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+
+# Marks the end of the stream in the queues between stages
+_END = object()
+
+
+class StageStats:
+    """Items processed by one pipeline stage and the time it spent working on them."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+
+    @property
+    def fps(self):
+        return self.frames / self.busy if self.busy > 0 else float('inf')
+
+    def as_dict(self, wall_time):
+        return {
+            'stage': self.name,
+            'frames': self.frames,
+            'busy_s': self.busy,
+            'fps': self.fps,
+            'utilization': self.busy / wall_time if wall_time > 0 else 0.0,
+        }
+
+
+def _put(q, item, stop):
+    # Block until there is room in the queue, unless another stage failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    # Block until an item arrives, unless another stage failed
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def run_pipeline(source, stages, queue_size=4, item_size=len):
+    """Run `source` and `stages` on separate threads connected by bounded queues.
+
+    :param source: (name, iterable) pair. The iterable is consumed on its own thread.
+    :param stages: list of (name, function) pairs. Each function receives the output of the
+                   previous stage; the return value of the last stage is discarded.
+    :param queue_size: maximum number of items waiting between two stages.
+    :param item_size: number of frames in a source item, used for the throughput report.
+    :return: (stats, wall_time) where stats is a list of StageStats in pipeline order.
+    """
+    source_name, iterable = source
+    stats = [StageStats(source_name)] + [StageStats(name) for name, _ in stages]
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stop = threading.Event()
+    errors = []
+
+    def run_source():
+        iterator = iter(iterable)
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            size = item_size(item)
+            stats[0].busy += time.perf_counter() - start
+            stats[0].frames += size
+            if not _put(queues[0], (size, item), stop):
+                return
+        _put(queues[0], _END, stop)
+
+    def run_stage(index, function):
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            entry = _get(inbox, stop)
+            if entry is _END:
+                break
+            size, item = entry
+            start = time.perf_counter()
+            result = function(item)
+            stats[index + 1].busy += time.perf_counter() - start
+            stats[index + 1].frames += size
+            if outbox is not None and not _put(outbox, (size, result), stop):
+                return
+        if outbox is not None:
+            _put(outbox, _END, stop)
+
+    def guarded(name, target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            # Record the failure and make every other stage drain out
+            errors.append((name, e))
+            stop.set()
+
+    threads = [threading.Thread(target=guarded, args=(source_name, run_source), daemon=True)]
+    for index, (name, function) in enumerate(stages):
+        threads.append(threading.Thread(target=guarded, args=(name, run_stage, index, function), daemon=True))
+
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        raise
+    wall_time = time.perf_counter() - wall_start
+
+    if errors:
+        name, error = errors[0]
+        raise RuntimeError(f"Pipeline stage '{name}' failed: {error}") from error
+    return stats, wall_time
+
+
+def print_stage_report(stats, wall_time):
+    """Print per-stage throughput and point out the stage that limits the pipeline."""
+    total = stats[0].frames
+    print(f"Processed {total} frames in {wall_time:.2f}s ({total / wall_time if wall_time > 0 else 0:.2f} FPS)")
+    for stage in stats:
+        row = stage.as_dict(wall_time)
+        print(f"  {row['stage']:<10} {row['fps']:8.2f} FPS  busy {row['busy_s']:7.2f}s  "
+              f"utilization {row['utilization']:6.1%}")
+    bottleneck = max(stats, key=lambda stage: stage.busy)
+    print(f"Bottleneck stage: {bottleneck.name}")
@@ -1,78 +1,183 @@
 import cv2
-from ultralytics import YOLO
-import numpy as np
+import glob
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from model_cache import get_model
+from overlay import draw_results
+from shards import is_shard_dir, open_shards, split_shard_path
+from stage_timing import stage
 
+IMAGE_TYPES = ('.jpg', '.jpeg', '.png')
 
-def predict_on_image(image_path, model_path, output_path, conf=0.1):
-    # Load the model
-    model = YOLO(model_path)
 
-    # Define colors for each category (in BGR format)
-    colors = {
-        'Tweezers': (0, 255, 0),
-        'Needle_driver': (0, 0, 255)
-    }
+def predict_on_image(image_path, model_path, output_path, conf=0.1, registry=None, roi=False, backend='pytorch'):
+    # Load the model, or reuse it if this process already loaded it
+    model = get_model(model_path, registry=registry, backend=backend)
 
     # Load the image
-    image = cv2.imread(image_path)
+    image = read_image(image_path)
     if image is None:
         print(f"Error: Could not load image at {image_path}")
         return
 
     # Perform segmentation on the image
-    results = model(image, conf=conf)
+    with stage('inference'):
+        results = model(image, conf=conf)
 
-    # Process results
-    for result in results:
-        masks = result.masks
-        boxes = result.boxes
-
-        if masks is not None:
-            for i in range(len(masks)):
-                mask = masks.data[i].cpu().numpy().astype(bool)
-                class_id = int(boxes[i].cls)
-                confidence = boxes[i].conf
-                category = model.names[class_id]
-
-                # Resize the mask to match the image dimensions
-                resized_mask = cv2.resize(mask.astype(np.uint8), (image.shape[1], image.shape[0]),
-                                          interpolation=cv2.INTER_NEAREST)
-                resized_mask = resized_mask.astype(bool)
-
-                # Create a color mask with the same shape as the image
-                color_mask = np.zeros_like(image)
-                color_mask[resized_mask] = colors.get(category, (255, 255, 255))
-
-                # Blend the color mask onto the image
-                image = cv2.addWeighted(image, 1, color_mask, 0.5, 0)
-
-                # Get the bounding box coordinates
-                box = boxes[i].xyxy.cpu().numpy()[0]
-                x1, y1, x2, y2 = map(int, box)
-
-                # Draw the bounding box on the image
-                cv2.rectangle(image, (x1, y1), (x2, y2), colors.get(category, (255, 255, 255)), 2)
-
-                # Prepare label with category and confidence score
-                label = f"{category} {confidence.item():.2f}"
-
-                # Draw the label on the image
-                cv2.putText(image, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
-                            colors.get(category, (255, 255, 255)), 2)
+    # Draw the masks, boxes and labels of all instances
+    image = draw_results(image, results, model.names, roi=roi)
 
     # Save the processed image
-    cv2.imwrite(output_path, image)
+    with stage('encode'):
+        cv2.imwrite(output_path, image)
     print(f"Processed image saved at {output_path}")
 
 
+def read_image(path):
+    """Read an image file, or a record of a shard directory (see shards.py), as BGR."""
+    with stage('decode') as timed:
+        image = _decode(path)
+        if image is None:
+            timed.frames = 0
+    return image
+
+
+def _decode(path):
+    record = split_shard_path(path)
+    if record is None:
+        return cv2.imread(path)
+    image = open_shards(record[0]).get(record[1])
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR if image.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+
+
+def collect_image_paths(inputs, types=IMAGE_TYPES):
+    """Expand a directory, a shard directory, a glob pattern, a single file or a list of those into image paths.
+
+    The records of a shard directory are listed as `<shard directory>/<key>`, which read_image reads.
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    paths = []
+    for entry in inputs:
+        if is_shard_dir(entry):
+            paths.extend(os.path.join(entry, key) for key in open_shards(entry).keys if key.lower().endswith(types))
+        elif os.path.isdir(entry):
+            paths.extend(os.path.join(entry, p) for p in sorted(os.listdir(entry)) if p.lower().endswith(types))
+        elif glob.has_magic(entry):
+            paths.extend(p for p in sorted(glob.glob(entry)) if p.lower().endswith(types))
+        else:
+            paths.append(entry)
+    return paths
+
+
+def read_batches(pool, paths, batch_size):
+    # Decode the next batch on the pool while the current one is being segmented
+    chunks = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    pending = [pool.submit(read_image, p) for p in chunks[0]] if chunks else []
+    for index, chunk in enumerate(chunks):
+        images = [future.result() for future in pending]
+        if index + 1 < len(chunks):
+            pending = [pool.submit(read_image, p) for p in chunks[index + 1]]
+        yield chunk, images
+
+
+def write_overlay(image, result, names, output_path, roi=False):
+    # Draw the masks, boxes and labels of all instances
+    image = draw_results(image, [result], names, roi=roi)
+
+    # Write to a temporary file first so an interrupted job never leaves a truncated output
+    root, ext = os.path.splitext(output_path)
+    partial_path = f"{root}.partial{ext}"
+    with stage('encode'):
+        if not cv2.imwrite(partial_path, image):
+            raise IOError(f"Could not write image to {output_path}")
+        os.replace(partial_path, output_path)
+
+
+def predict_on_images(inputs, model_path, output_dir, conf=0.1, batch_size=8, workers=4, registry=None,
+                      roi=False, backend='pytorch'):
+    """Segment many images, decoding and writing them on a thread pool.
+
+    :param inputs: a directory, a glob pattern, an image path or a list of those.
+    :param output_dir: directory for the processed images, written under their original names. Inputs
+                       from different directories with the same file name raise a ValueError.
+    :param batch_size: number of images sent to the model in one call.
+    :param workers: number of threads used to decode and write images.
+    :param roi: upsample and blend each mask only inside its bounding box.
+    :param backend: 'pytorch', or 'onnx' / 'openvino' to run an exported model on an optimized CPU runtime.
+    :return: list of output paths written by this call.
+    """
+    paths = collect_image_paths(inputs)
+
+    # Outputs are named after the input files, so two inputs with the same name would overwrite each other
+    duplicates = sorted(name for name, count in Counter(os.path.basename(p) for p in paths).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"{len(duplicates)} file names occur in more than one input and would be written to the "
+                         f"same output in {output_dir}, e.g. {duplicates[0]}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Skip images whose output already exists so an interrupted job can resume
+    todo = [p for p in paths if not os.path.exists(os.path.join(output_dir, os.path.basename(p)))]
+    skipped = len(paths) - len(todo)
+
+    # Load the model, or reuse it if this process already loaded it
+    model = get_model(model_path, registry=registry, backend=backend)
+
+    start = time.perf_counter()
+    written = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        writes = deque()
+        for chunk, images in read_batches(pool, todo, batch_size):
+            loaded = [(p, image) for p, image in zip(chunk, images) if image is not None]
+            for p, image in zip(chunk, images):
+                if image is None:
+                    print(f"Error: Could not load image at {p}")
+            if not loaded:
+                continue
+
+            # Perform segmentation on all images of the batch in a single call
+            with stage('inference', len(loaded)):
+                results = model([image for _, image in loaded], conf=conf, verbose=False)
+
+            for (p, image), result in zip(loaded, results):
+                output_path = os.path.join(output_dir, os.path.basename(p))
+                writes.append(pool.submit(write_overlay, image, result, model.names, output_path, roi))
+                written.append(output_path)
+
+            # Keep the number of images waiting to be written bounded
+            while len(writes) > 2 * workers * batch_size:
+                writes.popleft().result()
+
+        while writes:
+            writes.popleft().result()
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(written)} images in {elapsed:.2f}s "
+          f"({len(written) / elapsed if elapsed > 0 else 0:.2f} images/s), "
+          f"skipped {skipped} existing outputs")
+    return written
+
+
 def main():
     # Define paths
     image_path = 'my_path/input_image.jpg'  # Replace with the path to your input image
     model_path = 'yolov8_20_epochs_fine_tune.pt'  # Replace with the path to your YOLO model
+    backend = 'pytorch'  # 'onnx' or 'openvino' export the model once and run it on an optimized CPU runtime
     output_path = 'my_path/output_image.jpg'  # Replace with the desired output path for the processed image
 
+    input_dir = None  # Set to a directory, glob pattern or list of images to process many images at once
+    output_dir = 'my_path/output_images'  # Replace with the desired output directory when using input_dir
+
     # Call the prediction function
-    predict_on_image(image_path, model_path, output_path,conf=0.5)
+    if input_dir is not None:
+        predict_on_images(input_dir, model_path, output_dir, conf=0.5, backend=backend)
+    else:
+        predict_on_image(image_path, model_path, output_path,conf=0.5, backend=backend)
 
 
 if __name__ == "__main__":
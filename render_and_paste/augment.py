@@ -0,0 +1,202 @@
+"""Domain randomization of the pasted images, configured from JSON and applied in place on NumPy arrays.
+
+A configuration maps a stage to a list of operations:
+
+    {
+        "background": [{"op": "darken", "p": 0.3, "factor": [0.4, 0.9]}],
+        "composite": [{"op": "noise", "p": 0.5, "sigma": [2, 8]}]
+    }
+
+The "background" stage runs on the background before the render is pasted on it, the "composite"
+stage on the pasted image. Every operation runs with probability `p`; a parameter given as
+[low, high] is drawn uniformly for every image, a number is used as is. Operations change only the
+color channels of the RGB or RGBA image, an alpha channel is kept.
+"""
+
+import json
+import time
+import cv2
+import numpy as np
+from PIL import Image
+
+STAGES = ('background', 'composite')
+
+# The augmentation the paste script always had: darken the background at 0.3 probability
+DEFAULT_CONFIG = {'background': [{'op': 'darken', 'p': 0.3, 'factor': [0.4, 0.9]}]}
+
+
+def darken(image, rng, factor):
+    """Multiply the colors by `factor`, truncating like int() does."""
+    lut = np.arange(256, dtype=np.uint8).repeat(image.shape[2]).reshape(1, 256, image.shape[2])
+    lut[..., :3] = (np.arange(256) * max(0, min(factor, 1))).astype(np.uint8)[None, :, None]
+    cv2.LUT(image, lut, dst=image)
+
+
+def _color_mask(image, color, other):
+    # Per-channel values: `color` for the color channels, `other` for an alpha channel
+    return (color,) * 3 + (other,) * (image.shape[2] - 3)
+
+
+def color_jitter(image, rng, brightness=1.0, contrast=1.0, saturation=1.0):
+    """Scale saturation around the gray value, contrast around the mean and then brightness."""
+    # All three are linear in the colors, so they are applied as one affine color transform
+    weights = np.array([0.299, 0.587, 0.114])
+    mean = weights @ cv2.mean(image)[:3]
+    channels = image.shape[2]
+    matrix = np.zeros((channels, channels + 1))
+    matrix[:3, :3] = brightness * contrast * (saturation * np.eye(3) + (1 - saturation) * weights[None, :])
+    matrix[:3, channels] = brightness * mean * (1 - contrast)
+    matrix[3:, 3:channels] = np.eye(channels - 3)
+    cv2.transform(image, matrix, dst=image)
+
+
+def blur(image, rng, sigma):
+    """Gaussian blur, as from a slightly defocused camera."""
+    if image.shape[2] == 3:
+        cv2.GaussianBlur(image, (0, 0), sigma, dst=image)
+    else:
+        # Blur a copy of the color channels, the alpha channel is kept
+        image[..., :3] = cv2.GaussianBlur(np.ascontiguousarray(image[..., :3]), (0, 0), sigma)
+
+
+def noise(image, rng, sigma):
+    """Additive Gaussian sensor noise with standard deviation `sigma` gray levels."""
+    # OpenCV's generator is seeded from `rng` so the noise is reproducible
+    cv2.setRNGSeed(rng.getrandbits(31))
+    values = np.empty(image.shape, dtype=np.int16)
+    cv2.randn(values, 0, _color_mask(image, sigma, 0))
+    cv2.add(image, values, dst=image, dtype=cv2.CV_8U)
+
+
+def glare(image, rng, radius, intensity):
+    """Brighten a round spot of `radius` pixels at a random position, like a specular reflection."""
+    height, width = image.shape[:2]
+    x, y = rng.uniform(0, width), rng.uniform(0, height)
+    # Only the window around the spot is touched, the falloff is negligible beyond 3 radii
+    x1, x2 = int(max(x - 3 * radius, 0)), int(min(x + 3 * radius + 1, width))
+    y1, y2 = int(max(y - 3 * radius, 0)), int(min(y + 3 * radius + 1, height))
+    if x1 >= x2 or y1 >= y2:
+        return
+    xs = np.arange(x1, x2, dtype=np.float32) - x
+    ys = np.arange(y1, y2, dtype=np.float32) - y
+    spot = np.exp(-(ys[:, None] ** 2 + xs[None, :] ** 2) / (2 * radius ** 2)) * intensity
+    window = image[y1:y2, x1:x2, :3]
+    window[...] = np.clip(window + spot[..., None], 0, 255)
+
+
+_radius_maps = {}
+
+
+def vignette(image, rng, strength):
+    """Darken towards the corners by up to `strength` (0-1)."""
+    height, width = image.shape[:2]
+    radius = _radius_maps.get(image.shape)
+    if radius is None:
+        # Squared distance from the center, 1 in the corners and 0 for an alpha channel;
+        # the same for every image of a size
+        ys = np.linspace(-1, 1, height, dtype=np.float32)
+        xs = np.linspace(-1, 1, width, dtype=np.float32)
+        radius = (ys[:, None] ** 2 + xs[None, :] ** 2) / 2
+        radius = _radius_maps[image.shape] = cv2.merge(list(_color_mask(image, radius, np.zeros_like(radius))))
+    cv2.multiply(image, cv2.addWeighted(radius, -strength, radius, 0, 1), dst=image, dtype=cv2.CV_8U)
+
+
+OPERATIONS = {
+    'darken': darken,
+    'color_jitter': color_jitter,
+    'blur': blur,
+    'noise': noise,
+    'glare': glare,
+    'vignette': vignette,
+}
+
+
+class Augmentations:
+    """Operations of every stage, applied with their probability and timed.
+
+    :param config: dict of stage -> list of operations, see the module docstring.
+    """
+
+    def __init__(self, config=None):
+        config = DEFAULT_CONFIG if config is None else config
+        unknown = set(config) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown augmentation stages {sorted(unknown)}, expected {list(STAGES)}")
+        self.stages = {}
+        for stage, operations in config.items():
+            for operation in operations:
+                if operation.get('op') not in OPERATIONS:
+                    raise ValueError(f"Unknown augmentation '{operation.get('op')}', "
+                                     f"expected one of {sorted(OPERATIONS)}")
+            self.stages[stage] = [dict(operation) for operation in operations]
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path, 'r') as file:
+            return cls(json.load(file))
+
+    def apply(self, stage, image, rng, timings=None):
+        """Run the operations of `stage` on a PIL image and return the result.
+
+        The image is copied to an array only once the first operation is chosen, and every
+        operation then works on that array in place.
+        :param rng: random.Random instance deciding which operations run and with what parameters.
+        :param timings: dict of operation -> [times applied, seconds], accumulated. The copies
+                        between the image and the array are counted as 'convert'.
+        """
+        timings = {} if timings is None else timings
+        array = None
+        for operation in self.stages.get(stage, ()):
+            if rng.random() >= operation.get('p', 1.0):
+                continue
+            params = {key: rng.uniform(*value) if isinstance(value, list) else value
+                      for key, value in operation.items() if key not in ('op', 'p')}
+            if array is None:
+                start = time.perf_counter()
+                array = np.array(image)
+                _add_time(timings, 'convert', start)
+            start = time.perf_counter()
+            OPERATIONS[operation['op']](array, rng, **params)
+            _add_time(timings, operation['op'], start)
+        if array is None:
+            return image
+        start = time.perf_counter()
+        image = Image.fromarray(array)
+        _add_time(timings, 'convert', start, count=0)
+        return image
+
+    def apply_array(self, stage, array, rng, timings=None):
+        """Run the operations of `stage` in place on an RGB or RGBA uint8 array."""
+        timings = {} if timings is None else timings
+        for operation in self.stages.get(stage, ()):
+            if rng.random() >= operation.get('p', 1.0):
+                continue
+            params = {key: rng.uniform(*value) if isinstance(value, list) else value
+                      for key, value in operation.items() if key not in ('op', 'p')}
+            start = time.perf_counter()
+            OPERATIONS[operation['op']](array, rng, **params)
+            _add_time(timings, operation['op'], start)
+
+
+def _add_time(timings, name, start, count=1):
+    entry = timings.setdefault(name, [0, 0.0])
+    entry[0] += count
+    entry[1] += time.perf_counter() - start
+
+
+def merge_timings(total, timings):
+    """Add the timings of one image to the running `total`."""
+    for name, (count, seconds) in timings.items():
+        entry = total.setdefault(name, [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+
+
+def print_report(timings, images):
+    """Print the total time spent in every operation and the time per application."""
+    if not timings:
+        return
+    print(f"Augmentation time over {images} images:")
+    for name, (count, seconds) in sorted(timings.items(), key=lambda item: -item[1][1]):
+        print(f"  {name:<14} applied {count:>7} times, {seconds:8.2f} s total, "
+              f"{seconds * 1000 / max(count, 1):7.2f} ms each")
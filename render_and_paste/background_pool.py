@@ -0,0 +1,97 @@
+"""Indexed pool of background images with a memory-bounded cache of decoded, resized copies."""
+
+import hashlib
+import os
+import random
+import sys
+from collections import OrderedDict
+from PIL import Image
+from manifest import cached_file_hash
+
+# shards.py lives in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shards import is_shard_dir, open_shards
+
+
+class BackgroundPool:
+    """Backgrounds from one directory, indexed once and cached already resized to the render size.
+
+    :param directory: directory with the background images, or a shard directory (see shards.py).
+    :param types: file extensions to consider.
+    :param max_bytes: upper bound for the decoded backgrounds kept in memory.
+    :param replacement: sample with replacement (every draw independent) or without, going
+                        through a shuffled deck of all backgrounds before any is used again.
+    :param rng: random.Random instance used for sampling. Default: the `random` module.
+    """
+
+    def __init__(self, directory, types=('jpg', 'jpeg', 'png'), max_bytes=1024 ** 3, replacement=True, rng=None):
+        self.shards = open_shards(directory) if is_shard_dir(directory) else None
+        self.paths = sorted(
+            os.path.join(directory, p)
+            for p in (self.shards.keys if self.shards is not None else os.listdir(directory))
+            if p.lower().endswith(tuple(types))
+        )
+        if not self.paths:
+            raise FileNotFoundError(f"No background images found in {directory}")
+        self.max_bytes = max_bytes
+        self.replacement = replacement
+        self.rng = rng if rng is not None else random
+        self._deck = []
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def sample_path(self, rng=None):
+        """Pick the path of the next background.
+
+        :param rng: random.Random instance for this draw when sampling with replacement, e.g. one
+                    seeded per image. Default: the pool's rng.
+        """
+        if self.replacement:
+            return (rng or self.rng).choice(self.paths)
+        if not self._deck:
+            # Deal every background once, in a new random order, before repeating any
+            self._deck = list(self.paths)
+            self.rng.shuffle(self._deck)
+        return self._deck.pop()
+
+    def load(self, path, size, copy=True):
+        """Return an RGBA copy of the background at `path` resized to `size`, decoding it at most once.
+
+        :param copy: with False the cached image itself is returned, which must not be modified.
+        """
+        key = (path, tuple(size))
+        background = self._cache.get(key)
+        if background is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return background.copy() if copy else background
+
+        self.misses += 1
+        # A shard record is already decoded, its image shares memory with the shard until converted
+        source = self.shards.image(os.path.basename(path)) if self.shards is not None else Image.open(path)
+        background = source.convert('RGBA').resize(list(size))
+        nbytes = background.width * background.height * 4
+        if nbytes <= self.max_bytes:
+            self._cache[key] = background
+            self._bytes += nbytes
+            # Evict the least recently used backgrounds
+            while self._bytes > self.max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._bytes -= evicted.width * evicted.height * 4
+        return background.copy() if copy else background
+
+    def content_hash(self, path):
+        """SHA-256 of the background at `path`, of the file or of the decoded shard record."""
+        if self.shards is None:
+            return cached_file_hash(path)
+        return hashlib.sha256(self.shards.get(os.path.basename(path))).hexdigest()
+
+    def sample(self, size, rng=None, copy=True):
+        """Pick a background and return (path, RGBA image resized to `size`)."""
+        path = self.sample_path(rng)
+        return path, self.load(path, size, copy)
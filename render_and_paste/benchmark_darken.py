@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of augment.darken, the background darkening of the paste script, against the
+original per-pixel implementation."""
+
+import argparse
+import time
+import numpy as np
+from PIL import Image
+from augment import darken
+
+
+def darken_image_per_pixel(image, factor):
+    """Original implementation, looping over every pixel with getpixel/putpixel."""
+    factor = max(0, min(factor, 1))
+    darkened_image = Image.new("RGBA", image.size)
+    for x in range(image.width):
+        for y in range(image.height):
+            r, g, b, a = image.getpixel((x, y))
+            darkened_image.putpixel((x, y), (int(r * factor), int(g * factor), int(b * factor), a))
+    return darkened_image
+
+
+def darken_array(image, factor):
+    """Darken a copy of `image` with augment.darken, as the paste script does with its backgrounds."""
+    pixels = np.array(image)
+    darken(pixels, None, factor)
+    return Image.fromarray(pixels)
+
+
+def best_time(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s",
+                        "--size",
+                        default=(1920, 1080),
+                        type=int,
+                        nargs=2,
+                        help="Width and height of the test background. Default: 1920 1080.")
+    parser.add_argument("-f",
+                        "--factor",
+                        default=0.65,
+                        type=float,
+                        help="Darkness factor. Default: 0.65.")
+    parser.add_argument("-r",
+                        "--repeat",
+                        default=20,
+                        type=int,
+                        help="Timed runs of the vectorized version. Default: 20.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    width, height = args.size
+    image = Image.fromarray(rng.integers(0, 256, (height, width, 4), dtype=np.uint8))
+
+    # Both versions must give the same pixels, including the untouched alpha channel
+    reference = darken_image_per_pixel(image, args.factor)
+    vectorized = darken_array(image, args.factor)
+    identical = np.array_equal(np.asarray(reference), np.asarray(vectorized))
+
+    per_pixel_time = best_time(lambda: darken_image_per_pixel(image, args.factor), 1)
+    vectorized_time = best_time(lambda: darken_array(image, args.factor), args.repeat)
+    print(f"Image size: {width}x{height}, identical output: {identical}")
+    print(f"Per-pixel:  {per_pixel_time * 1000:10.1f} ms")
+    print(f"Vectorized: {vectorized_time * 1000:10.1f} ms")
+    print(f"Speedup:    {per_pixel_time / vectorized_time:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Train on renders pasted on random backgrounds on the fly, instead of writing composites to disk.
+
+The training images are the transparent RGBA renders, laid out like any YOLO dataset (an `images`
+directory next to a `labels` directory, which yolo_labels.py can write from coco_annotations.json).
+Every time a data loader worker loads a render it pastes it on a freshly drawn background and runs
+the augmentations of augment.py, so every epoch sees new backgrounds and nothing is written to disk.
+Validation uses the ordinary dataset.
+
+    from ultralytics import YOLO
+    YOLO('yolov8n-seg.pt').train(data='data.yaml', trainer=compositing_trainer('backgrounds'))
+"""
+
+import argparse
+import math
+import random
+import cv2
+import numpy as np
+from ultralytics import YOLO
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.segment import SegmentationTrainer
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import de_parallel
+
+from augment import Augmentations
+from background_pool import BackgroundPool
+
+
+def paste(render, background):
+    """Alpha-composite a BGRA render over an RGBA background of the same size, in place on the background."""
+    alpha = render[..., 3:].astype(np.uint16)
+    colors = render[..., 2::-1] * alpha + background[..., :3] * (255 - alpha)
+    colors += 127
+    colors //= 255
+    background[..., :3] = colors
+
+
+class CompositingDataset(YOLODataset):
+    """YOLODataset whose images are RGBA renders pasted on a random background whenever they are loaded.
+
+    :param backgrounds: directory of background images.
+    :param augmentations: Augmentations of the background and of the pasted image. Default: the
+                          paste script's darkening of the background.
+    :param cache_mb: memory for decoded, resized backgrounds in every data loader worker.
+    Other arguments are those of YOLODataset. Images are never cached, a cached composite would keep
+    its background.
+    """
+
+    def __init__(self, *args, backgrounds, augmentations=None, cache_mb=256, **kwargs):
+        self.backgrounds_dir = backgrounds
+        self.augmentations = augmentations or Augmentations()
+        self.cache_mb = cache_mb
+        self._backgrounds = None
+        kwargs['cache'] = False
+        super().__init__(*args, **kwargs)
+
+    @property
+    def backgrounds(self):
+        # Created on first use, so every data loader worker has its own cache
+        if self._backgrounds is None:
+            self._backgrounds = BackgroundPool(self.backgrounds_dir, max_bytes=self.cache_mb * 1024 ** 2)
+        return self._backgrounds
+
+    def load_image(self, i, rect_mode=True):
+        """Paste render `i` on a random background and return (BGR image, original hw, resized hw)."""
+        render = cv2.imread(self.im_files[i], cv2.IMREAD_UNCHANGED)
+        if render is None:
+            raise FileNotFoundError(f"Image Not Found {self.im_files[i]}")
+        if render.ndim != 3 or render.shape[2] != 4:
+            raise ValueError(f"{self.im_files[i]} has no alpha channel to paste it with")
+
+        # Resized first, like YOLODataset does, so the pasting runs at training resolution
+        h0, w0 = render.shape[:2]
+        if rect_mode:
+            r = self.imgsz / max(h0, w0)
+            w, h = (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz)) if r != 1 else (w0, h0)
+        else:
+            w, h = self.imgsz, self.imgsz
+        if (w, h) != (w0, h0):
+            render = cv2.resize(render, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        # The workers' `random` state is seeded by the data loader
+        _, background = self.backgrounds.sample([w, h], random, copy=False)
+        background = np.array(background)
+        self.augmentations.apply_array("background", background, random)
+        paste(render, background)
+        self.augmentations.apply_array("composite", background, random)
+        im = cv2.cvtColor(background, cv2.COLOR_RGBA2BGR)
+
+        # Only the index is buffered, mosaic picks its partners from it and they get a new background too
+        if self.augment:
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return im, (h0, w0), im.shape[:2]
+
+
+def compositing_trainer(backgrounds, augment=None, cache_mb=256):
+    """SegmentationTrainer class whose training images are composited on the fly.
+
+    :param backgrounds: directory of background images.
+    :param augment: JSON file of augmentations, see augment.py. Default: darken the background.
+    :param cache_mb: memory for decoded, resized backgrounds in every data loader worker.
+    The class is created per call, so it is meant for single device training; ultralytics' multi-GPU
+    mode imports the trainer class by name in new processes.
+    """
+    augmentations = Augmentations.from_json(augment) if augment else Augmentations()
+
+    class CompositingTrainer(SegmentationTrainer):
+        def build_dataset(self, img_path, mode="train", batch=None):
+            if mode != "train":
+                return super().build_dataset(img_path, mode, batch)
+            gs = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+            return CompositingDataset(
+                img_path=img_path,
+                imgsz=self.args.imgsz,
+                batch_size=batch,
+                augment=True,
+                hyp=self.args,
+                rect=self.args.rect,
+                single_cls=self.args.single_cls or False,
+                stride=gs,
+                pad=0.0,
+                prefix=colorstr(f"{mode}: "),
+                task=self.args.task,
+                classes=self.args.classes,
+                data=self.data,
+                fraction=self.args.fraction,
+                backgrounds=backgrounds,
+                augmentations=augmentations,
+                cache_mb=cache_mb,
+            )
+
+    return CompositingTrainer
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", default="yolov8n-seg.pt", type=str,
+                        help="Weights to start from. Default: 'yolov8n-seg.pt'.")
+    parser.add_argument("-d", "--data", type=str, required=True,
+                        help="Dataset YAML whose train images are the transparent renders.")
+    parser.add_argument("-b", "--backgrounds", type=str, required=True, help="Directory of background images.")
+    parser.add_argument("-a", "--augment", type=str, help="JSON file of augmentations, see augment.py.")
+    parser.add_argument("--cache-mb", default=256, type=int,
+                        help="Memory for decoded backgrounds per data loader worker in MB. Default: 256.")
+    parser.add_argument("--epochs", default=20, type=int, help="Default: 20.")
+    parser.add_argument("--imgsz", default=640, type=int, help="Default: 640.")
+    parser.add_argument("--batch", default=16, type=int, help="Default: 16.")
+    args = parser.parse_args()
+
+    YOLO(args.model).train(data=args.data, epochs=args.epochs, imgsz=args.imgsz, batch=args.batch,
+                           trainer=compositing_trainer(args.backgrounds, args.augment, args.cache_mb))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""This script draws the YOLO polygon labels of a dataset on its images, like synthetic_images_examples/images_with_mask."""
+
+import os
+import sys
+import random
+import argparse
+from multiprocessing import Pool
+import cv2
+import numpy as np
+from tqdm import tqdm
+from yolo_labels import parse_label, read_label
+
+# shards.py lives in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shards import is_shard_dir, open_shards
+
+# Colors of the classes in BGR, the same as the prediction overlays
+CLASS_COLORS = {
+    0: (0, 0, 255),  # Needle_driver, red
+    1: (0, 255, 0),  # Tweezers, green
+}
+FALLBACK_COLOR = (255, 255, 255)
+
+
+def draw_polygons(image, polygons, alpha=0.4, thickness=2):
+    """Fill and outline normalized (class, polygon) instances on a BGR image.
+
+    All polygons of a class are rasterized by one fillPoly and one polylines call, and the fill is
+    blended over the whole image at once.
+    """
+    height, width = image.shape[:2]
+    by_class = {}
+    for class_id, polygon in polygons:
+        by_class.setdefault(class_id, []).append(np.round(polygon * (width, height)).astype(np.int32))
+
+    filled = image.copy()
+    for class_id, points in by_class.items():
+        cv2.fillPoly(filled, points, CLASS_COLORS.get(class_id, FALLBACK_COLOR))
+    output = cv2.addWeighted(filled, alpha, image, 1 - alpha, 0)
+    for class_id, points in by_class.items():
+        cv2.polylines(output, points, True, CLASS_COLORS.get(class_id, FALLBACK_COLOR), thickness)
+    return output
+
+
+def load(images, labels, file_name):
+    """Return the BGR image and the instances of `file_name`, from files or from a shard directory."""
+    if is_shard_dir(images):
+        shards = open_shards(images)
+        image = shards.get(file_name)
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        else:
+            image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGR if image.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+        # Label files packed with the images take precedence
+        if "label" in shards.names(file_name):
+            return image, parse_label(bytes(shards.get(file_name, "label")).decode())
+    else:
+        image = cv2.imread(os.path.join(images, file_name))
+    return image, read_label(os.path.join(labels, os.path.splitext(file_name)[0] + ".txt"))
+
+
+def draw_file(file_name, args):
+    image, polygons = load(args.images, args.labels, file_name)
+    if image is None:
+        print(f"Error: Could not load image {file_name}")
+        return 0
+    output = draw_polygons(image, polygons, args.alpha, args.thickness)
+    if args.scale != 1:
+        output = cv2.resize(output, None, fx=args.scale, fy=args.scale, interpolation=cv2.INTER_AREA)
+
+    # Write to a temporary file first so an interrupted run never leaves a truncated output
+    output_path = os.path.join(args.output, os.path.splitext(file_name)[0] + "_masked.png")
+    if not cv2.imwrite(output_path + ".partial.png", output):
+        raise IOError(f"Could not write image to {output_path}")
+    os.replace(output_path + ".partial.png", output_path)
+    return len(polygons)
+
+
+# Per-process state of the worker pool
+_worker = {}
+
+
+def _init_worker(args):
+    _worker["args"] = args
+
+
+def _draw_task(file_name):
+    return draw_file(file_name, _worker["args"])
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--images", type=str, required=True,
+                        help="Directory of images, or a shard directory (see shards.py).")
+    parser.add_argument("-l", "--labels", type=str,
+                        help="Directory of YOLO label files. Default: 'labels' next to `images`.")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output directory for the *_masked.png.")
+    parser.add_argument("-t", "--types", default=('jpg', 'jpeg', 'png'), type=str, nargs='+',
+                        help="File types to consider. Default: jp[e]g, png.")
+    parser.add_argument("-n", "--sample", type=float,
+                        help="Draw only a random subset: a number of images, or a fraction if below 1. Default: all.")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the random subset. Default: 0.")
+    parser.add_argument("--alpha", default=0.4, type=float, help="Opacity of the filled polygons. Default: 0.4.")
+    parser.add_argument("--thickness", default=2, type=int, help="Outline thickness in pixels. Default: 2.")
+    parser.add_argument("--scale", default=1.0, type=float, help="Scale of the written images. Default: 1.")
+    parser.add_argument("-j", "--workers", default=os.cpu_count(), type=int,
+                        help="Processes drawing in parallel. Default: number of CPUs.")
+    args = parser.parse_args()
+
+    if args.labels is None:
+        args.labels = os.path.join(os.path.dirname(os.path.abspath(args.images)), "labels")
+    os.makedirs(args.output, exist_ok=True)
+
+    names = open_shards(args.images).keys if is_shard_dir(args.images) else os.listdir(args.images)
+    file_names = sorted(f for f in names if f.lower().endswith(tuple(args.types)))
+    if args.sample is not None:
+        count = round(args.sample * len(file_names)) if args.sample < 1 else int(args.sample)
+        file_names = sorted(random.Random(args.seed).sample(file_names, min(count, len(file_names))))
+
+    instances = 0
+    with Pool(max(1, args.workers), initializer=_init_worker, initargs=(args,)) as pool:
+        for count in tqdm(pool.imap_unordered(_draw_task, file_names, chunksize=16), total=len(file_names)):
+            instances += count
+    print(f"Drew {instances} instances on {len(file_names)} images into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
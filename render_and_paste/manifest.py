@@ -0,0 +1,77 @@
+"""Record of the finished items of a paste run, one JSON line per item, so a run can be resumed."""
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+
+def file_hash(path):
+    """SHA-256 of the contents of `path`, or None if it does not exist."""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def cached_file_hash(path):
+    """file_hash of a file that does not change during the run, e.g. a background."""
+    return file_hash(path)
+
+
+def data_hash(data):
+    """SHA-256 of anything JSON serializable."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(path):
+    """Return dict of file name -> latest record in the manifest at `path`.
+
+    A line cut off by a crash is ignored, its item simply counts as not done.
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record['file']] = record
+    return records
+
+
+class ManifestWriter:
+    """Appends one record per finished item and flushes it right away.
+
+    :param resume: keep the records already in the file. Otherwise the manifest is started over.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        if resume and os.path.exists(path):
+            # Rewrite the latest record of every item, dropping superseded and torn lines
+            records = load_manifest(path)
+            with open(path + ".partial", 'w') as file:
+                for record in records.values():
+                    file.write(json.dumps(record) + "\n")
+            os.replace(path + ".partial", path)
+        self._file = open(path, 'a' if resume else 'w')
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
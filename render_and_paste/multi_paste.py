@@ -0,0 +1,104 @@
+"""Paste several renders on one background, tracking which parts of each stay visible."""
+
+import cv2
+import numpy as np
+from PIL import Image
+from yolo_labels import alpha_polygons
+
+# Alpha from which a pixel counts as covered by a render
+OPAQUE = 128
+
+
+def random_affine(rng, source_size, target_size, scale=(0.6, 1.0), rotation=180.0, flip=0.5):
+    """2x3 matrix that scales, rotates and possibly mirrors a render about its center and moves it
+    to a random position, anywhere from the center of the target to half its size away."""
+    (source_w, source_h), (target_w, target_h) = source_size, target_size
+    matrix = cv2.getRotationMatrix2D((source_w / 2, source_h / 2), rng.uniform(-rotation, rotation),
+                                     rng.uniform(*scale))
+    if rng.random() < flip:
+        matrix[0] = -matrix[0]
+        matrix[0, 2] += source_w
+    matrix[0, 2] += (target_w - source_w) / 2 + rng.uniform(-0.5, 0.5) * target_w
+    matrix[1, 2] += (target_h - source_h) / 2 + rng.uniform(-0.5, 0.5) * target_h
+    return matrix
+
+
+def _instance_masks(render, instances, label_class):
+    # One mask per labelled instance of the render, in render coordinates
+    if instances is None:
+        return [(label_class, (render[..., 3] >= OPAQUE).astype(np.uint8))]
+    masks = []
+    for class_id, polygon in instances:
+        mask = np.zeros(render.shape[:2], dtype=np.uint8)
+        cv2.fillPoly(mask, [np.round(polygon).astype(np.int32)], 1)
+        masks.append((class_id, mask))
+    return masks
+
+
+def paste_instances(background, renders, rng, scale=(0.6, 1.0), rotation=180.0, flip=0.5, min_visible=0.25,
+                    labels=False, label_class=0):
+    """Paste `renders` on `background` in a random z-order.
+
+    The first render keeps its place, the others are randomly transformed (random_affine). Going
+    from the top of the stack down, each render's visible part is what the renders kept above it
+    leave uncovered. A render whose visible area is below `min_visible` of its full area (so mostly
+    hidden or outside the frame) is dropped and not pasted, which uncovers the renders below it.
+
+    :param background: RGBA PIL image.
+    :param renders: list of (RGBA PIL image, instances); instances are the (class, polygon) of the
+                    render, or None to use its alpha outline as one instance of `label_class`.
+    :param labels: also return the visible (class, polygon) of every instance.
+    :return: (RGBA PIL image, list of visible (class, polygon), number of dropped renders).
+    """
+    width, height = background.size
+    layers = []
+    for index, (render, instances) in enumerate(renders):
+        array = np.asarray(render.convert("RGBA"))
+        masks = _instance_masks(array, instances, label_class) if labels else []
+        area = np.count_nonzero(array[..., 3] >= OPAQUE)
+        if index == 0 and render.size == (width, height):
+            layers.append((array, masks, area))
+            continue
+        matrix = random_affine(rng, render.size, (width, height), scale, rotation, flip)
+        warped = cv2.warpAffine(array, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        masks = [(class_id, cv2.warpAffine(mask, matrix, (width, height), flags=cv2.INTER_NEAREST))
+                 for class_id, mask in masks]
+        # Area the render would have if fully inside the frame, scaled by the transform
+        layers.append((warped, masks, area * abs(np.linalg.det(matrix[:, :2]))))
+    order = list(range(len(layers)))
+    rng.shuffle(order)
+
+    # From the top down: keep what is visible enough and accumulate what it covers
+    covered = np.zeros((height, width), dtype=bool)
+    kept, polygons, dropped = [], [], 0
+    for index in reversed(order):
+        array, masks, area = layers[index]
+        opaque = array[..., 3] >= OPAQUE
+        visible = np.count_nonzero(opaque & ~covered)
+        if area == 0 or visible < min_visible * area:
+            dropped += 1
+            continue
+        for class_id, mask in masks:
+            mask[covered] = 0
+            polygons.extend(alpha_polygons(mask, class_id))
+        covered |= opaque
+        kept.append(array)
+
+    # Alpha-composite the kept renders bottom up, rounding like PIL's paste
+    canvas = np.array(background)
+    colors = canvas[..., :3].astype(np.uint16)
+    for array in reversed(kept):
+        alpha = array[..., 3:].astype(np.uint16)
+        colors *= 255 - alpha
+        colors += array[..., :3] * alpha
+        colors += 127
+        colors //= 255
+    canvas[..., :3] = colors
+    return Image.fromarray(canvas), polygons, dropped
+
+
+def choose_partners(rng, file_names, index, count):
+    """Pick `count` renders other than `file_names[index]` to share its background."""
+    picks = rng.sample(range(len(file_names) - 1), min(count, len(file_names) - 1))
+    return [file_names[i + (i >= index)] for i in picks]
@@ -1,29 +1,171 @@
 #!/usr/bin/env python3
 """This script allows to automatically paste generated images on random backgrounds."""
 
+import io
 import os
 import random
+import sys
+import hashlib
 import argparse
+from multiprocessing import Pool
 from PIL import Image
 from tqdm import tqdm
+from background_pool import BackgroundPool
+# shards.py lives in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shards import is_shard_dir, open_shards
+from augment import Augmentations, merge_timings, print_report
+from manifest import ManifestWriter, load_manifest, file_hash, data_hash
+from multi_paste import paste_instances, choose_partners
+from yolo_labels import coco_polygons, alpha_polygons, format_label, write_label, label_path
 
 
-def darken_image(image, factor):
-    """Darken the image by a given factor (0.0 - 1.0)."""
-    # Ensure the factor is between 0 and 1
-    factor = max(0, min(factor, 1))
+def file_seed(file_name, seed=0):
+    """Seed for one image, derived from its file name so it does not depend on the processing order."""
+    digest = hashlib.sha256(f"{seed}:{file_name}".encode()).digest()
+    return int.from_bytes(digest[:8], "little")
 
-    # Create a new image with the same size and mode as the original
-    darkened_image = Image.new("RGBA", image.size)
 
-    # Darken each pixel in the image
-    for x in range(image.width):
-        for y in range(image.height):
-            r, g, b, a = image.getpixel((x, y))
-            # Apply the darkness factor
-            darkened_image.putpixel((x, y), (int(r * factor), int(g * factor), int(b * factor), a))
+def save_atomic(image, path):
+    """Save `image` to a temporary file next to `path` and rename it, so an interrupted run never
+    leaves a truncated image behind (when overwriting, the original render would be lost).
+
+    :return: SHA-256 of the saved file.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format=Image.registered_extensions()[os.path.splitext(path)[1].lower()])
+    tmp_path = path + ".partial"
+    with open(tmp_path, "wb") as file:
+        file.write(buffer.getvalue())
+    os.replace(tmp_path, path)
+    return hashlib.sha256(buffer.getvalue()).hexdigest()
+
+
+def up_to_date(previous, record, img_path, output_path, labels_path, overwrite):
+    """Whether the item of manifest record `previous` was made from the same inputs and its outputs are intact."""
+    if any(previous.get(key) != value for key, value in record.items() if key != "input"):
+        return False
+    if overwrite:
+        # The input was replaced by the output, which must be unchanged since
+        if file_hash(img_path) != previous["output_hash"]:
+            return False
+    elif record["input"] != previous["input"] or file_hash(output_path) != previous["output_hash"]:
+        return False
+    return labels_path is None or file_hash(labels_path) == previous.get("label_hash")
+
+
+def read_input(args, file_name):
+    """Read an image once and return (hash of what was read, lazily decoded PIL image)."""
+    # A shard record is already decoded
+    if args.image_shards:
+        array = open_shards(args.images).get(file_name)
+        return hashlib.sha256(array).hexdigest(), Image.fromarray(array)
+    with open(os.path.join(args.images, file_name), "rb") as file:
+        data = file.read()
+    return hashlib.sha256(data).hexdigest(), Image.open(io.BytesIO(data))
+
+
+def composite(file_name, background_path, args, backgrounds, augmentations, polygons=None, previous=None,
+              partners=None):
+    """Paste one image on a background and save it, with its YOLO label file if `args.labels` is set.
+
+    :param background_path: background assigned up front, or None to draw one with the image's own seed.
+    :param augmentations: Augmentations applied to the background and to the pasted image.
+    :param polygons: (class, polygon) instances of the image read from the COCO annotations.
+    :param previous: manifest record of an earlier run; the image is skipped while it is up to date.
+    :param partners: (file name, polygons) of other renders pasted on the same background, see multi_paste.py.
+    :return: (manifest record, time spent in every augmentation, whether the image was composited).
+    """
+    seed = file_seed(file_name, args.seed)
+    rng = random.Random(seed)
+    img_path = os.path.join(args.images, file_name)
+    # Overwrites original image with merged one if `overwrite` is selected
+    if args.overwrite:
+        output_path = img_path
+    # Else store merged image in default or provided `output` directory
+    else:
+        output_filename = file_name  # Retain the original filename
+        output_path = os.path.join(args.output, output_filename)
+    labels_path = label_path(output_path) if args.labels else None
+
+    # Selecting a random background
+    if background_path is None:
+        background_path = backgrounds.sample_path(rng)
+
+    # The images are read once, for their hash and for decoding
+    input_hash, img = read_input(args, file_name)
+    partner_inputs = [read_input(args, partner) for partner, _ in partners or []]
+    record = {
+        "file": file_name,
+        "input": input_hash,
+        "background": background_path,
+        "background_hash": backgrounds.content_hash(background_path),
+        "seed": seed,
+        "settings": args.settings_hash,
+        "annotations": data_hash([[int(c), p.tolist()] for c, p in polygons]) if polygons else None,
+    }
+    if partners:
+        record["partners"] = [partner for partner, _ in partners]
+        record["partners_hash"] = data_hash([partner_hash for partner_hash, _ in partner_inputs] +
+                                            [[[int(c), p.tolist()] for c, p in instances or []]
+                                             for _, instances in partners])
+    if previous is not None and up_to_date(previous, record, img_path, output_path, labels_path, args.overwrite):
+        return previous, {}, False
+
+    img_w, img_h = img.size
+
+    # The background is decoded and resized to the image size at most once
+    background = backgrounds.load(background_path, [img_w, img_h])
+    #background = Image.open(background_path).convert('RGBA').resize([960, 544])
+
+    # Augment the background, by default darkening it at 0.3 probability
+    timings = {}
+    background = augmentations.apply("background", background, rng, timings)
+    # Pasting the current image on the selected background
+    #background.paste(img, mask=img.convert('RGBA'))
+    if partners:
+        # Several renders in a random z-order, labelled by what stays visible of them
+        instances = (lambda p: p or []) if args.labels == "coco" else (lambda p: None)
+        renders = [(img, instances(polygons))] + [(partner_img, instances(partner_polygons))
+                                                   for (_, partner_img), (_, partner_polygons)
+                                                   in zip(partner_inputs, partners)]
+        background, polygons, _ = paste_instances(background, renders, rng, scale=args.instance_scale,
+                                                  rotation=args.max_rotation, min_visible=args.min_visible,
+                                                  labels=bool(args.labels), label_class=args.alpha_class)
+    else:
+        background.paste(img, mask=img)
+    background = augmentations.apply("composite", background, rng, timings)
+
+    record["output"] = output_path
+    record["output_hash"] = save_atomic(background, output_path)
+
+    # Labels come from the alpha channel that is already decoded, or from the annotations
+    if args.labels == "alpha" and not partners:
+        polygons = alpha_polygons(img.getchannel("A"), args.alpha_class)
+    if args.labels:
+        write_label(labels_path, format_label(polygons or [], img_w, img_h))
+        record["label_hash"] = file_hash(labels_path)
+    return record, timings, True
+
+
+# Per-process state of the worker pool
+_worker = {}
+
+
+def _init_worker(args):
+    _worker["args"] = args
+    _worker["augmentations"] = Augmentations.from_json(args.augment) if args.augment else Augmentations()
+    _worker["backgrounds"] = BackgroundPool(args.backgrounds,
+                                            types=args.types,
+                                            max_bytes=args.cache_mb * 1024 ** 2 // args.workers,
+                                            replacement=not args.no_replacement)
+
+
+def _composite_task(task):
+    file_name, background_path, polygons, previous, partners = task
+    return composite(file_name, background_path, _worker["args"], _worker["backgrounds"], _worker["augmentations"],
+                     polygons, previous, partners)
 
-    return darkened_image
 
 def main():
     # Get and parse all given arguments
@@ -31,11 +173,11 @@ def main():
     parser.add_argument("-i",
                         "--images",
                         type=str,
-                        help="Path to object images to paste.")
+                        help="Path to object images to paste, a directory or a shard directory (see shards.py).")
     parser.add_argument("-b",
                         "--backgrounds",
                         type=str,
-                        help="Path to background images to paste on.")
+                        help="Path to background images to paste on, a directory or a shard directory.")
     parser.add_argument("-t",
                         "--types",
                         default=('jpg', 'jpeg', 'png'),
@@ -53,55 +195,174 @@ def main():
                         "--output",
                         default="output",
                         type=str,
-                        help="Output directory. Default: 'output'.")
+                        help="Output directory. Default: 'output' inside the image directory, or "
+                             "'<shard directory>_output' next to a shard directory.")
+    parser.add_argument("--cache-mb",
+                        default=1024,
+                        type=int,
+                        help="Memory for decoded, resized backgrounds in MB, shared by all workers. Default: 1024.")
+    parser.add_argument("--no-replacement",
+                        action="store_true",
+                        help=
+                        "Use every background once before repeating any, spreading them evenly. Default: False."
+                        )
+    parser.add_argument("-j",
+                        "--workers",
+                        default=1,
+                        type=int,
+                        help="Processes compositing in parallel. Default: 1.")
+    parser.add_argument("--seed",
+                        default=0,
+                        type=int,
+                        help=
+                        "Base seed; every image gets its own seed derived from it and its file name, "
+                        "so the outputs do not depend on --workers. Default: 0."
+                        )
+    parser.add_argument("--labels",
+                        choices=("coco", "alpha"),
+                        help=
+                        "Write a YOLO polygon label file next to every output, from the COCO annotations of the "
+                        "renders or from the outlines of the alpha channel. Default: no labels."
+                        )
+    parser.add_argument("--annotations",
+                        type=str,
+                        help="COCO annotations for --labels coco. Default: coco_annotations.json next to `images`.")
+    parser.add_argument("--alpha-class",
+                        default=0,
+                        type=int,
+                        help="Class of every alpha outline for --labels alpha. Default: 0.")
+    parser.add_argument("-a",
+                        "--augment",
+                        type=str,
+                        help=
+                        "JSON file with the augmentations of the background and of the pasted image, see "
+                        "augment.py. Default: darken the background at 0.3 probability."
+                        )
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help=
+                        "Skip the images the manifest records as done whose inputs and outputs are unchanged, "
+                        "and redo the rest. Default: False, start over."
+                        )
+    parser.add_argument("--manifest",
+                        type=str,
+                        help="Manifest of finished images. Default: manifest.jsonl in the output directory.")
+    parser.add_argument("-k",
+                        "--instances",
+                        default=1,
+                        type=int,
+                        help=
+                        "Renders pasted on every background: the image itself and K-1 other renders, randomly "
+                        "scaled, rotated, mirrored and moved, in a random z-order. Default: 1."
+                        )
+    parser.add_argument("--instance-scale",
+                        default=(0.6, 1.0),
+                        type=float,
+                        nargs=2,
+                        help="Scale range of the other renders. Default: 0.6 1.0.")
+    parser.add_argument("--max-rotation",
+                        default=180.0,
+                        type=float,
+                        help="Largest rotation of the other renders in degrees. Default: 180.")
+    parser.add_argument("--min-visible",
+                        default=0.25,
+                        type=float,
+                        help=
+                        "Renders with less of their area visible (covered by later renders or outside the frame) "
+                        "are left out. Default: 0.25."
+                        )
     args = parser.parse_args()
+    args.image_shards = is_shard_dir(args.images)
+    if args.image_shards and args.overwrite:
+        parser.error("--overwrite needs a directory of image files, not a shard directory")
+    if args.instances > 1 and args.overwrite:
+        # Partner renders are read from the image directory, which --overwrite replaces as the run goes
+        parser.error("--instances above 1 needs the original renders, it cannot be combined with --overwrite")
 
     # Create an output directory if `overwrite` is not selected
     if not args.overwrite:
         if args.output == "output":
-            os.makedirs(os.path.join(args.images, "output"), exist_ok=True)
-        else:
-            os.makedirs(args.output, exist_ok=True)
-
-    # Go through all files in given `images` directory
-    for file_name in tqdm(os.listdir(args.images)):
-        # Matching files to given `types` and opening images
-        if file_name.lower().endswith(args.types):
-            img_path = os.path.join(args.images, file_name)
-            img = Image.open(img_path)
-            img_w, img_h = img.size
-
-            # Selecting and opening a random image file from given `backgrounds` directory to use as background
-            background_path = random.choice([
-                os.path.join(args.backgrounds, p)
-                for p in os.listdir(args.backgrounds)
-                if p.lower().endswith(args.types)
-            ])
-            background = Image.open(background_path).convert('RGBA').resize([img_w, img_h])
-            #background = Image.open(background_path).convert('RGBA').resize([960, 544])
-
-            # Darken the background randomly
-            if random.random() < 0.3: #at 0.3 probability apply transformation of darkening to background
-                darkness_factor = random.uniform(0.4, 0.9)  # Random factor between 0.4 and 0.9
-                background = darken_image(background, darkness_factor)
-            # Pasting the current image on the selected background
-            #background.paste(img, mask=img.convert('RGBA'))
-            background.paste(img, mask=img)
-
-
-            # Overwrites original image with merged one if `overwrite` is selected
-            if args.overwrite:
-                background.save(img_path)
-            # Else store merged image in default or provided `output` directory
+            # Nothing may be added inside a shard directory, its outputs go next to it
+            if args.image_shards:
+                args.output = os.path.normpath(args.images) + "_output"
             else:
-                output_filename = file_name  # Retain the original filename
-                if args.output == "output":
-                    output_path = os.path.join(args.images, "output", output_filename)
-                else:
-                    output_path = os.path.join(args.output, output_filename)
+                args.output = os.path.join(args.images, "output")
+        os.makedirs(args.output, exist_ok=True)
+    args.types = tuple(args.types)
+    args.workers = max(1, args.workers)
+    output_dir = args.images if args.overwrite else args.output
+    manifest_path = args.manifest or os.path.join(output_dir, "manifest.jsonl")
 
-                background.save(output_path)
+    # Temporary files of a run that was interrupted while writing
+    for file_name in os.listdir(output_dir):
+        if file_name.endswith(".partial"):
+            os.remove(os.path.join(output_dir, file_name))
+
+    # Everything besides the image, its background and its annotations that changes the outputs
+    augmentations = Augmentations.from_json(args.augment) if args.augment else Augmentations()
+    args.settings_hash = data_hash({"seed": args.seed, "no_replacement": args.no_replacement,
+                                    "augmentations": augmentations.stages, "labels": args.labels,
+                                    "alpha_class": args.alpha_class, "instances": args.instances,
+                                    "instance_scale": list(args.instance_scale), "max_rotation": args.max_rotation,
+                                    "min_visible": args.min_visible})
+
+    # Index the `backgrounds` directory once
+    backgrounds = BackgroundPool(args.backgrounds,
+                                 types=args.types,
+                                 max_bytes=args.cache_mb * 1024 ** 2 // args.workers,
+                                 replacement=not args.no_replacement,
+                                 rng=random.Random(args.seed))
+
+    # Matching files to given `types`, listed before anything is written so that overwritten
+    # files are never picked up twice
+    names = open_shards(args.images).keys if args.image_shards else os.listdir(args.images)
+    file_names = sorted(f for f in names if f.lower().endswith(args.types))
+
+    # The annotations are read once; workers only get the polygons of their images
+    polygons = {}
+    if args.labels == "coco":
+        annotations = args.annotations or os.path.join(os.path.dirname(os.path.abspath(args.images)),
+                                                       "coco_annotations.json")
+        polygons = coco_polygons(annotations)
+
+    # Without replacement the deck is dealt here, in file name order, so every worker count
+    # assigns the same backgrounds; with replacement every image draws its own with its seed
+    previous = load_manifest(manifest_path) if args.resume else {}
+    # The other renders of every image are drawn with a seed of its own as well
+    partners = [[(partner, polygons.get(partner))
+                 for partner in choose_partners(random.Random(file_seed(file_name + ":partners", args.seed)),
+                                                file_names, index, args.instances - 1)]
+                if args.instances > 1 else None
+                for index, file_name in enumerate(file_names)]
+    tasks = [(file_name, backgrounds.sample_path() if args.no_replacement else None, polygons.get(file_name),
+              previous.get(file_name), image_partners)
+             for file_name, image_partners in zip(file_names, partners)]
+
+    # Go through all files in given `images` directory
+    timings = {}
+    composited = 0
+    with ManifestWriter(manifest_path, resume=args.resume) as manifest:
+        if args.workers == 1:
+            results = (composite(file_name, background_path, args, backgrounds, augmentations, *task)
+                       for file_name, background_path, *task in tasks)
+            for record, image_timings, done in tqdm(results, total=len(tasks)):
+                if done:
+                    manifest.write(record)
+                    composited += 1
+                merge_timings(timings, image_timings)
+        else:
+            with Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+                # Progress of all workers is reported as images complete, in whatever order they finish
+                results = pool.imap_unordered(_composite_task, tasks, chunksize=16)
+                for record, image_timings, done in tqdm(results, total=len(tasks)):
+                    # Written as soon as the image is saved, so a crash loses no finished work
+                    if done:
+                        manifest.write(record)
+                        composited += 1
+                    merge_timings(timings, image_timings)
+    print(f"Composited {composited} images, {len(tasks) - composited} were up to date")
+    print_report(timings, composited)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,32 +1,18 @@
 import blenderproc as bproc
 from blenderproc.python.camera import CameraUtility
-import bpy
 import numpy as np
 import argparse
 import json
 import random
 import os
+import sys
 
-def filter_annotations_by_category(data, valid_category_ids):
-    filtered_data = {
-        'category_id_segmaps': [],
-        'instance_segmaps': [],
-        'instance_attribute_maps': [],
-        'colors': []
-    }
+# render_core.py lives in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from render_core import (AssetPool, Checkpoint, CocoStream, LightPool, RenderMonitor,
+                         filter_annotations_by_category, principled_material, shard_work)
 
-    for idx, (seg_map, instance_map, attrs) in enumerate(zip(data['category_id_segmaps'], data['instance_segmaps'], data['instance_attribute_maps'])):
-        filtered_data['category_id_segmaps'].append(seg_map)
-        filtered_data['instance_segmaps'].append(instance_map)
 
-        # Filter instance attributes by category ID
-        filtered_attrs = [attr for attr in attrs if attr['category_id'] in valid_category_ids]
-        filtered_data['instance_attribute_maps'].append(filtered_attrs)
-
-        # You can also store the colors if needed
-        filtered_data['colors'].append(data['colors'][idx])
-
-    return filtered_data
 # Function to load paths from a configuration file
 def load_paths_from_config(config_file):
     with open(config_file, 'r') as file:
@@ -44,6 +30,8 @@ def load_paths_from_config(config_file):
 # Argument parser setup
 parser = argparse.ArgumentParser()
 parser.add_argument('--config', required=True, help="Path to the configuration JSON file.")
+parser.add_argument('--resume', action='store_true',
+                    help="Continue an interrupted run from the checkpoint.json in its output directory.")
 args = parser.parse_args()
 
 # Load object paths and parameters from the config file
@@ -73,16 +61,36 @@ num_images_per_obj=num_images // (len(needle_holders)+len(tweezers))
 
 poses = 0
 instance_id=0
-all_objects = needle_holders + tweezers
-
-for obj_path in all_objects:
+# All of them, or this shard's part when started by render_launcher.py
+all_objects = shard_work(args.config, needle_holders + tweezers)
+# Meshes, lights and the hand material are created once and reused by every pair
+assets = AssetPool()
+lights = LightPool()
+monitor = RenderMonitor()
+# Progress is saved after every render() call, --resume continues from it
+checkpoint = Checkpoint(os.path.join(output_dir, 'checkpoint.json'))
+resume = checkpoint.load() if args.resume else None
+# Frames are appended to coco_data/annotations.jsonl, coco_annotations.json is built from it at the end.
+# Resuming without a checkpoint starts from the first pair, so the frames already logged are dropped
+keep_images = resume['images'] if resume else (0 if args.resume else None)
+coco = CocoStream(os.path.join(output_dir, 'coco_data'), keep_images=keep_images)
+
+for pair_index, obj_path in enumerate(all_objects):
+    # Tools finished before the checkpoint
+    if resume is not None and pair_index < resume['pair']:
+        continue
+    if resume is not None:
+        # Continue with the state the run had when it finished the previous tool
+        poses, instance_id = resume['poses'], resume['instance_id']
+        Checkpoint.restore_random_state(resume)
+        resume = None
     # bproc.clean_up(True)  # This will remove all objects from the scene
-    for obj_x in bpy.context.scene.objects:
-        if obj_x.type == 'MESH':
-            bpy.data.objects.remove(obj_x, do_unlink=True)
-    obj = bproc.loader.load_obj(obj_path)[0]
+    # Hide the objects of the previous pair, they stay loaded for reuse
+    assets.release_all()
+    lights.release_all()
+    obj = assets.acquire(obj_path)
 
-    hand_obj = bproc.loader.load_obj(hand_occlude_path)[0]
+    hand_obj = assets.acquire(hand_occlude_path)
     hand_obj.set_cp("category_id", 10)
     new_scale = hand_obj.get_scale() * 4
     new_scale[1] = -new_scale[1]
@@ -90,12 +98,15 @@ for obj_path in all_objects:
     hand_obj.set_location(obj.get_location() + np.array([0, -0.2, -1.6]))
     # hand_obj.set_location(obj.get_location() + np.random.uniform([-0.4, -0.4, -0.4], [0.4, 0.4, 0.4])+np.array([0,0,-1.2]))
     # Darken hand_obj material
-    hand_material = bproc.material.create(name="hand_material")
-    # hand_material.set_principled_shader_value("Base Color", (0.1, 0.1, 0.1, 1.0))  # Dark gray color
-    # hand_material.set_principled_shader_value("Base Color", (0.3, 0.25, 0.2, 1.0))  # Darkest beige
-    hand_material.set_principled_shader_value("Base Color", (0.2, 0.18, 0.16, 1.0))  # Dark gray-beige
-    hand_material.set_principled_shader_value("Specular", 0.1)  # Low specular for a matte finish
-    hand_material.set_principled_shader_value("Roughness", 0.8)  # High roughness for less shine
+    # Created once, later pairs reuse it
+    # Base_Color=(0.1, 0.1, 0.1, 1.0)  # Dark gray color
+    # Base_Color=(0.3, 0.25, 0.2, 1.0)  # Darkest beige
+    hand_material = principled_material(
+        "hand_material",
+        Base_Color=(0.2, 0.18, 0.16, 1.0),  # Dark gray-beige
+        Specular=0.1,  # Low specular for a matte finish
+        Roughness=0.8  # High roughness for less shine
+    )
     hand_obj.replace_materials(hand_material)
 
     if obj_path in needle_holders:
@@ -113,8 +124,7 @@ for obj_path in all_objects:
     while tries < 300 and poses - initial_poses < num_images_per_obj:
         # Set random world lighting strength
         #bpy.data.worlds["World"].node_tree.nodes["Background"].inputs[1].default_value = np.random.uniform(0.1, 1.5)
-        light = bproc.types.Light()
-        light.set_type("POINT")
+        light = lights.acquire("POINT")
 
         if obj_path in tweezers:
             mat=obj.get_materials()[0]
@@ -187,13 +197,11 @@ for obj_path in all_objects:
     filtered_data = filter_annotations_by_category(data, valid_category_ids)
 
     # Write the filtered data to COCO file
-    bproc.writer.write_coco_annotations(
-        os.path.join(output_dir, 'coco_data'),
-        instance_segmaps=filtered_data["instance_segmaps"],
-        instance_attribute_maps=filtered_data["instance_attribute_maps"],
-        colors=filtered_data["colors"],
-        mask_encoding_format="polygon",
-        append_to_existing_output=True
-    )
+    coco.write(filtered_data)
     bproc.utility.reset_keyframes()
+    monitor.frames_done(poses - initial_poses)
+    checkpoint.save(pair=pair_index + 1, poses=poses, instance_id=instance_id, images=coco.log.next_image_id)
+
+coco.close()
+monitor.report()
 
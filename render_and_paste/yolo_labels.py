@@ -0,0 +1,116 @@
+"""YOLO segmentation labels (one `class x1 y1 x2 y2 ...` polygon per line, normalized to 0-1)."""
+
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+
+
+def coco_polygons(annotations_path, class_offset=-1):
+    """Read the polygons of a BlenderProc COCO file, indexed by image file name.
+
+    :param class_offset: added to the COCO category id to get the YOLO class. Default: -1, the
+                         renders number the needle holder 1 and the tweezers 2.
+    :return: dict of image file name -> list of (class, N x 2 polygon in pixels).
+    """
+    with open(annotations_path, 'r') as file:
+        data = json.load(file)
+    file_names = {image['id']: os.path.basename(image['file_name']) for image in data['images']}
+    polygons = {name: [] for name in file_names.values()}
+    for annotation in data['annotations']:
+        segmentation = annotation['segmentation']
+        # Only polygon encoded masks (mask_encoding_format="polygon") carry polygons
+        if not isinstance(segmentation, list):
+            continue
+        for polygon in segmentation:
+            if len(polygon) >= 6:
+                polygons[file_names[annotation['image_id']]].append(
+                    (annotation['category_id'] + class_offset, np.asarray(polygon, dtype=np.float64).reshape(-1, 2)))
+    return polygons
+
+
+def alpha_polygons(alpha, class_id, epsilon=1.0, min_area=16):
+    """Outline every opaque region of an alpha channel as one polygon of class `class_id`.
+
+    :param epsilon: maximum distance in pixels between a contour and its simplified polygon.
+    :param min_area: regions smaller than this many pixels are dropped.
+    """
+    contours, _ = cv2.findContours((np.asarray(alpha) > 0).astype(np.uint8), cv2.RETR_EXTERNAL,
+                                   cv2.CHAIN_APPROX_SIMPLE)
+    polygons = []
+    for contour in contours:
+        if cv2.contourArea(contour) < min_area:
+            continue
+        if epsilon > 0:
+            contour = cv2.approxPolyDP(contour, epsilon, True)
+        if len(contour) >= 3:
+            polygons.append((class_id, contour.reshape(-1, 2).astype(np.float64)))
+    return polygons
+
+
+def format_label(polygons, width, height):
+    """Lines of a YOLO label file for `polygons` in an image of `width` x `height` pixels."""
+    lines = []
+    for class_id, polygon in polygons:
+        points = np.clip(polygon / (width, height), 0, 1)
+        lines.append(f"{int(class_id)} " + " ".join(f"{value:.6f}" for value in points.ravel()))
+    return lines
+
+
+def write_label(path, lines):
+    """Write a label file through a temporary file, so it is never left half written."""
+    tmp_path = path + ".partial"
+    with open(tmp_path, 'w') as file:
+        file.write("".join(line + "\n" for line in lines))
+    os.replace(tmp_path, path)
+
+
+def parse_label(text):
+    """Instances of a label file's text as a list of (class, N x 2 polygon normalized to 0-1)."""
+    polygons = []
+    for line in text.splitlines():
+        values = line.split()
+        if len(values) >= 7:
+            polygons.append((int(values[0]), np.array(values[1:], dtype=np.float64).reshape(-1, 2)))
+    return polygons
+
+
+def read_label(path):
+    """parse_label of the file at `path`, no instances if it does not exist."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as file:
+        return parse_label(file.read())
+
+
+def label_path(image_path):
+    """Label file written next to an image."""
+    return os.path.splitext(image_path)[0] + ".txt"
+
+
+def write_coco_labels(annotations_path, labels_dir, class_offset=-1):
+    """Write a label file named after every image of a COCO file into `labels_dir`."""
+    with open(annotations_path, 'r') as file:
+        sizes = {os.path.basename(image['file_name']): (image['width'], image['height'])
+                 for image in json.load(file)['images']}
+    os.makedirs(labels_dir, exist_ok=True)
+    for file_name, polygons in coco_polygons(annotations_path, class_offset).items():
+        write_label(label_path(os.path.join(labels_dir, file_name)), format_label(polygons, *sizes[file_name]))
+    return len(sizes)
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser(description="Write YOLO label files of the renders from their COCO annotations.")
+    parser.add_argument("annotations", type=str, help="coco_annotations.json written by the render scripts.")
+    parser.add_argument("labels", type=str, help="Output directory of the label files.")
+    parser.add_argument("--class-offset", default=-1, type=int,
+                        help="Added to the COCO category id to get the YOLO class. Default: -1.")
+    args = parser.parse_args()
+    count = write_coco_labels(args.annotations, args.labels, args.class_offset)
+    print(f"Wrote {count} label files to {args.labels}")
+
+
+if __name__ == "__main__":
+    main()
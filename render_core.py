@@ -0,0 +1,330 @@
+"""Shared scene management for the BlenderProc generators.
+
+Import after `import blenderproc as bproc`. The generators used to load every mesh again for every
+tool pair, create a new material per pair and a new light per frame, so a long run kept adding data
+to the scene. Here every mesh file is parsed once and its objects are shown or hidden as scenes
+change, and lights, materials and the HDRI world node are reused.
+"""
+
+import json
+import os
+import random
+import shutil
+import time
+
+import blenderproc as bproc
+import bpy
+import numpy as np
+
+from coco_log import LOG_NAME, CocoLogWriter, build_coco, truncate_log
+
+
+def filter_annotations_by_category(data, valid_category_ids):
+    filtered_data = {
+        'category_id_segmaps': [],
+        'instance_segmaps': [],
+        'instance_attribute_maps': [],
+        'colors': []
+    }
+
+    for idx, (seg_map, instance_map, attrs) in enumerate(zip(data['category_id_segmaps'], data['instance_segmaps'], data['instance_attribute_maps'])):
+        filtered_data['category_id_segmaps'].append(seg_map)
+        filtered_data['instance_segmaps'].append(instance_map)
+
+        # Filter instance attributes by category ID
+        filtered_attrs = [attr for attr in attrs if attr['category_id'] in valid_category_ids]
+        filtered_data['instance_attribute_maps'].append(filtered_attrs)
+
+        # You can also store the colors if needed
+        filtered_data['colors'].append(data['colors'][idx])
+
+    return filtered_data
+
+
+def shard_work(config_file, work):
+    """The part of `work` this process renders when render_launcher.py started it, else all of it.
+
+    The launcher adds `shard_index`, `num_shards`, `seed` and `cpu_threads` to the config of every
+    shard. The seed seeds `random` and NumPy, so every shard draws its own reproducible poses, and
+    the renderer uses `cpu_threads` threads so the shards running at once share the CPUs.
+    """
+    with open(config_file, 'r') as file:
+        config = json.load(file)
+    if 'seed' in config:
+        random.seed(config['seed'])
+        np.random.seed(config['seed'])
+    if 'cpu_threads' in config:
+        bproc.renderer.set_cpu_threads(config['cpu_threads'])
+    return work[config.get('shard_index', 0)::config.get('num_shards', 1)]
+
+
+class AssetPool:
+    """Objects of mesh files, parsed once and reused.
+
+    acquire() hands out an object of a file with the transform it had when loaded. A second object
+    of a file in use at the same time (e.g. a hand for each tool) is a linked duplicate, sharing the
+    mesh data. release_all() hides every handed out object and makes it available again.
+    """
+
+    def __init__(self):
+        self._free = {}
+        self._used = []
+        self._initial = {}
+        self.loads = 0
+
+    def acquire(self, path):
+        """Return the first object of `path`, visible and with its original transform."""
+        free = self._free.setdefault(path, [])
+        if free:
+            parts = free.pop()
+        else:
+            in_use = [parts for used_path, parts in self._used if used_path == path]
+            if in_use:
+                parts = [part.duplicate(linked=True) for part in in_use[0]]
+            else:
+                parts = bproc.loader.load_obj(path)
+                self._initial[path] = [part.get_local2world_mat() for part in parts]
+                self.loads += 1
+        for part, matrix in zip(parts, self._initial[path]):
+            part.set_local2world_mat(matrix)
+            part.hide(False)
+        self._used.append((path, parts))
+        return parts[0]
+
+    def release_all(self):
+        """Hide all objects handed out since the last call, they are reused by later scenes."""
+        for path, parts in self._used:
+            for part in parts:
+                part.hide(True)
+            self._free[path].append(parts)
+        self._used = []
+
+
+class LightPool:
+    """Lights reused across frames instead of adding a new one every frame."""
+
+    def __init__(self):
+        self._free = []
+        self._used = []
+
+    def acquire(self, light_type="POINT"):
+        light = self._free.pop() if self._free else bproc.types.Light()
+        light.set_type(light_type)
+        light.blender_obj.hide_render = False
+        self._used.append(light)
+        return light
+
+    def release_all(self):
+        """Switch off all lights handed out since the last call."""
+        for light in self._used:
+            light.blender_obj.hide_render = True
+        self._free.extend(self._used)
+        self._used = []
+
+
+_materials = {}
+
+
+def principled_material(name, **values):
+    """Material `name` with the given principled shader values, created once per run.
+
+    Keyword names use underscores for spaces, e.g. Base_Color=(0.2, 0.18, 0.16, 1.0).
+    """
+    material = _materials.get(name)
+    if material is None:
+        material = _materials[name] = bproc.material.create(name=name)
+        for key, value in values.items():
+            material.set_principled_shader_value(key.replace("_", " "), value)
+    return material
+
+
+def keyframe_shader_value(material, input_name, value, frame):
+    """Set a principled shader input of `material` and keyframe it at `frame`."""
+    material.set_principled_shader_value(input_name, value)
+    socket = material.get_the_one_node_with_type("BsdfPrincipled").inputs[input_name]
+    socket.keyframe_insert("default_value", frame=frame)
+
+
+class WorldHdri:
+    """Switches the HDRI of the world, reusing one environment texture node and loading every file once.
+
+    set() changes the HDRI of every frame. To give the frames of one render() call different HDRIs,
+    call start_batch() and then keyframe() for every frame: each HDRI of the batch gets a background
+    node, the nodes are summed, and the strength of every node is keyframed to 1 on the frames of its
+    HDRI and to 0 on all others.
+    """
+
+    def __init__(self):
+        self._node = None
+        self._batch_nodes = []
+        self._backgrounds = {}
+        self._frames = []
+
+    def set(self, path):
+        if self._node is None or self._node.name not in bpy.context.scene.world.node_tree.nodes:
+            bproc.world.set_world_background_hdr_img(path)
+            self._node = [node for node in bpy.context.scene.world.node_tree.nodes
+                          if node.bl_idname == "ShaderNodeTexEnvironment"][-1]
+        else:
+            self._node.image = bpy.data.images.load(path, check_existing=True)
+
+    def start_batch(self):
+        """Remove the nodes of the previous batch."""
+        nodes = bpy.context.scene.world.node_tree.nodes
+        for node in self._batch_nodes:
+            nodes.remove(node)
+        self._batch_nodes = []
+        self._backgrounds = {}
+        self._frames = []
+
+    def keyframe(self, path, frame):
+        """Show HDRI `path` on `frame` of the current batch."""
+        tree = bpy.context.scene.world.node_tree
+        if path not in self._backgrounds:
+            texture = tree.nodes.new("ShaderNodeTexEnvironment")
+            texture.image = bpy.data.images.load(path, check_existing=True)
+            background = tree.nodes.new("ShaderNodeBackground")
+            tree.links.new(texture.outputs["Color"], background.inputs["Color"])
+            self._batch_nodes += [texture, background]
+            output = [node for node in tree.nodes if node.type == "OUTPUT_WORLD"][0]
+            if self._backgrounds:
+                add = tree.nodes.new("ShaderNodeAddShader")
+                self._batch_nodes.append(add)
+                tree.links.new(output.inputs["Surface"].links[0].from_socket, add.inputs[0])
+                tree.links.new(background.outputs["Background"], add.inputs[1])
+                tree.links.new(add.outputs["Shader"], output.inputs["Surface"])
+            else:
+                tree.links.new(background.outputs["Background"], output.inputs["Surface"])
+            # Off on the frames keyframed before it was added
+            strength = background.inputs["Strength"]
+            strength.default_value = 0.0
+            for previous in self._frames:
+                strength.keyframe_insert("default_value", frame=previous)
+            self._backgrounds[path] = background
+        for key, background in self._backgrounds.items():
+            strength = background.inputs["Strength"]
+            strength.default_value = 1.0 if key == path else 0.0
+            strength.keyframe_insert("default_value", frame=frame)
+        self._frames.append(frame)
+
+
+class CocoStream:
+    """Writes the frames of every render() call to the COCO log of `coco_dir` (see coco_log.py).
+
+    BlenderProc writes every call's frames to a fresh staging directory, so its polygons and images
+    are unchanged, and the images are moved into `coco_dir`/images under the ids the log gives them.
+    close() builds coco_annotations.json from the log, once.
+
+    :param keep_images: when resuming, the number of images logged at the checkpoint. Frames logged
+                        after it are dropped, they are rendered again under the same ids.
+    """
+
+    def __init__(self, coco_dir, keep_images=None):
+        self.coco_dir = coco_dir
+        self.staging = os.path.join(coco_dir, 'staging')
+        os.makedirs(os.path.join(coco_dir, 'images'), exist_ok=True)
+        if keep_images is not None:
+            truncate_log(os.path.join(coco_dir, LOG_NAME), keep_images)
+        self.log = CocoLogWriter(os.path.join(coco_dir, LOG_NAME))
+
+    def write(self, data):
+        """Log the frames of `data`, the (filtered) output of bproc.renderer.render()."""
+        shutil.rmtree(self.staging, ignore_errors=True)
+        bproc.writer.write_coco_annotations(
+            self.staging,
+            instance_segmaps=data["instance_segmaps"],
+            instance_attribute_maps=data["instance_attribute_maps"],
+            colors=data["colors"],
+            mask_encoding_format="polygon",
+            append_to_existing_output=False
+        )
+        with open(os.path.join(self.staging, 'coco_annotations.json'), 'r') as file:
+            coco = json.load(file)
+        if not self.log.has_header:
+            self.log.write_header(coco.get('info', {}), coco.get('licenses', []))
+        by_image = {}
+        for annotation in coco['annotations']:
+            by_image.setdefault(annotation['image_id'], []).append(annotation)
+        for image in coco['images']:
+            file_name = os.path.join('images', f"{self.log.next_image_id:06d}" + os.path.splitext(image['file_name'])[1])
+            # The image is in place before its line is logged, a logged frame always has its image
+            os.replace(os.path.join(self.staging, image['file_name']), os.path.join(self.coco_dir, file_name))
+            self.log.write_frame(dict(image, file_name=file_name), by_image.get(image['id'], []), coco['categories'])
+
+    def close(self):
+        """Build coco_annotations.json from the log."""
+        self.log.close()
+        shutil.rmtree(self.staging, ignore_errors=True)
+        return build_coco(self.log.path, os.path.join(self.coco_dir, 'coco_annotations.json'))
+
+
+class Checkpoint:
+    """Progress of a generator, saved to `path` after every render() call.
+
+    save() stores the given values together with the states of `random` and of NumPy's global
+    generator, so a run restarted with --resume draws the same poses, materials and lights as a run
+    that was never interrupted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """The saved values, or None if there is no checkpoint."""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as file:
+            return json.load(file)
+
+    def save(self, **state):
+        version, internal, gauss_next = random.getstate()
+        name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+        state['random'] = [version, list(internal), gauss_next]
+        state['numpy'] = [name, keys.tolist(), position, has_gauss, cached_gaussian]
+        # Written atomically, a crash while saving keeps the previous checkpoint
+        with open(self.path + '.partial', 'w') as file:
+            json.dump(state, file)
+        os.replace(self.path + '.partial', self.path)
+
+    @staticmethod
+    def restore_random_state(state):
+        version, internal, gauss_next = state['random']
+        random.setstate((version, tuple(internal), gauss_next))
+        name, keys, position, has_gauss, cached_gaussian = state['numpy']
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
+
+
+def scene_counts():
+    """Number of objects, meshes, materials, lights, images and world nodes in the blend file."""
+    world = bpy.context.scene.world
+    return {
+        'objects': len(bpy.data.objects),
+        'meshes': len(bpy.data.meshes),
+        'materials': len(bpy.data.materials),
+        'lights': len(bpy.data.lights),
+        'images': len(bpy.data.images),
+        'world_nodes': len(world.node_tree.nodes) if world is not None and world.node_tree is not None else 0,
+    }
+
+
+class RenderMonitor:
+    """Prints the time per frame and the scene size every `every` frames, both should stay flat."""
+
+    def __init__(self, every=50):
+        self.every = every
+        self.frames = 0
+        self._last_frames = 0
+        self._last_time = time.perf_counter()
+
+    def frames_done(self, count=1):
+        self.frames += count
+        if self.frames - self._last_frames >= self.every:
+            self.report()
+
+    def report(self):
+        now = time.perf_counter()
+        frames = self.frames - self._last_frames
+        if frames:
+            counts = ", ".join(f"{key} {value}" for key, value in scene_counts().items())
+            print(f"Frames {self.frames}: {(now - self._last_time) / frames:.2f} s/frame, {counts}")
+        self._last_frames, self._last_time = self.frames, now
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Run a BlenderProc generator as several Blender processes and merge their COCO output.
+
+The work list of the generator (its tool pairs or tools) is split round robin into shards. Every
+shard runs in its own Blender process with a config that adds `shard_index`, `num_shards`, its own
+`seed` and `cpu_threads` (the CPUs divided among the processes running at once), and writes to its
+own `shard_NNN` output directory. The shard COCO files are then merged
+into `coco_data` of the output directory, with image and annotation ids renumbered and the images
+linked under their new names, so the result looks like the output of a single run.
+
+    python render_launcher.py render_on_hdri/synthetic_data_generator.py --config render_on_hdri/config.json -n 4
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import time
+
+from coco_log import LOG_NAME, read_coco_log
+
+COCO_DIR = 'coco_data'
+COCO_NAME = 'coco_annotations.json'
+
+
+def shard_dir(output, index):
+    return os.path.join(output, f"shard_{index:03d}")
+
+
+def shard_threads(num_shards, max_parallel=None):
+    """Render threads of every shard, so the Blender processes running at once share the CPUs."""
+    running = min(num_shards, max_parallel or num_shards)
+    return max(1, (os.cpu_count() or 1) // running)
+
+
+def write_shard_configs(config_file, output, num_shards, seed, cpu_threads=None):
+    """Write the config of every shard into its output directory and return their paths."""
+    with open(config_file, 'r') as file:
+        config = json.load(file)
+    if cpu_threads is not None:
+        config['cpu_threads'] = cpu_threads
+    paths = []
+    for index in range(num_shards):
+        directory = shard_dir(output, index)
+        os.makedirs(directory, exist_ok=True)
+        shard_config = dict(config, shard_index=index, num_shards=num_shards, seed=seed + index,
+                            output_dir=os.path.abspath(directory))
+        path = os.path.join(directory, 'config.json')
+        with open(path, 'w') as file:
+            json.dump(shard_config, file, indent=4)
+        paths.append(path)
+    return paths
+
+
+def run_shards(script, configs, blenderproc='blenderproc', max_parallel=None, resume=False):
+    """Run `blenderproc run script --config <shard config>` for every config, at most `max_parallel` at once.
+
+    The output of every process goes to log.txt next to its config. With `resume` every shard
+    continues from its checkpoint.
+    :return: list of the exit codes.
+    """
+    max_parallel = max_parallel or len(configs)
+    pending = list(enumerate(configs))
+    running = {}
+    codes = [None] * len(configs)
+    while pending or running:
+        while pending and len(running) < max_parallel:
+            index, config = pending.pop(0)
+            log = open(os.path.join(os.path.dirname(config), 'log.txt'), 'a' if resume else 'w')
+            command = [blenderproc, 'run', script, '--config', config] + (['--resume'] if resume else [])
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+            running[index] = (process, log)
+        for index, (process, log) in list(running.items()):
+            if process.poll() is not None:
+                log.close()
+                codes[index] = process.returncode
+                del running[index]
+                print(f"Shard {index} finished with exit code {process.returncode}")
+        time.sleep(1)
+    return codes
+
+
+def _link(source, target):
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def merge_coco(coco_dirs, output_dir):
+    """Merge the BlenderProc COCO directories `coco_dirs` into `output_dir`.
+
+    Images and annotations are renumbered in the order of `coco_dirs`, and the images are hard
+    linked (or copied) into `output_dir`/images under names made from their new ids.
+    :return: (number of images, number of annotations).
+    """
+    os.makedirs(os.path.join(output_dir, 'images'), exist_ok=True)
+    merged = None
+    categories = {}
+    for coco_dir in coco_dirs:
+        path = os.path.join(coco_dir, COCO_NAME)
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                data = json.load(file)
+        elif os.path.exists(os.path.join(coco_dir, LOG_NAME)):
+            # The shard stopped before building its COCO file, its log has every finished frame
+            header, images, annotations, shard_categories = read_coco_log(os.path.join(coco_dir, LOG_NAME))
+            data = dict(header, images=images, annotations=annotations, categories=shard_categories)
+        else:
+            print(f"Warning: {path} does not exist, skipping it")
+            continue
+        if merged is None:
+            merged = {key: value for key, value in data.items() if key not in ('images', 'annotations', 'categories')}
+            merged['images'], merged['annotations'] = [], []
+        for category in data.get('categories', []):
+            categories.setdefault(category['id'], category)
+
+        image_ids = {}
+        for image in data['images']:
+            new_id = len(merged['images'])
+            image_ids[image['id']] = new_id
+            file_name = os.path.join('images', f"{new_id:06d}" + os.path.splitext(image['file_name'])[1])
+            _link(os.path.join(coco_dir, image['file_name']), os.path.join(output_dir, file_name))
+            merged['images'].append(dict(image, id=new_id, file_name=file_name))
+        for annotation in data['annotations']:
+            merged['annotations'].append(dict(annotation, id=len(merged['annotations']),
+                                              image_id=image_ids[annotation['image_id']]))
+
+    if merged is None:
+        merged = {'images': [], 'annotations': []}
+    merged['categories'] = [categories[key] for key in sorted(categories)]
+    # Written atomically, readers never see a half merged file
+    path = os.path.join(output_dir, COCO_NAME)
+    with open(path + '.partial', 'w') as file:
+        json.dump(merged, file)
+    os.replace(path + '.partial', path)
+    return len(merged['images']), len(merged['annotations'])
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script", type=str, help="BlenderProc script, e.g. render_on_hdri/synthetic_data_generator.py.")
+    parser.add_argument("--config", type=str, required=True, help="Config JSON of the script.")
+    parser.add_argument("-n", "--shards", default=2, type=int,
+                        help="Number of shards, each rendered by its own Blender process holding its own copy of "
+                             "the scene in memory. Default: 2.")
+    parser.add_argument("-p", "--max-parallel", type=int,
+                        help="Blender processes running at once. Default: all shards.")
+    parser.add_argument("--threads", type=int,
+                        help="Render threads per Blender process. Default: the CPUs divided by the processes "
+                             "running at once.")
+    parser.add_argument("--seed", default=43, type=int, help="Seed of shard 0, shard i gets seed + i. Default: 43.")
+    parser.add_argument("-o", "--output", type=str, help="Output directory. Default: output_dir of the config.")
+    parser.add_argument("--blenderproc", default="blenderproc", type=str, help="BlenderProc executable.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue interrupted shards from their checkpoints, with the same -n and --seed.")
+    parser.add_argument("--merge-only", action="store_true", help="Only merge the COCO files of existing shards.")
+    args = parser.parse_args()
+
+    if args.output is None:
+        with open(args.config, 'r') as file:
+            args.output = json.load(file)['output_dir']
+
+    if not args.merge_only:
+        threads = args.threads or shard_threads(args.shards, args.max_parallel)
+        configs = write_shard_configs(args.config, args.output, args.shards, args.seed, threads)
+        codes = run_shards(args.script, configs, args.blenderproc, args.max_parallel, args.resume)
+        failed = [index for index, code in enumerate(codes) if code != 0]
+        if failed:
+            print(f"Warning: shards {failed} failed, see their log.txt; merging what they wrote")
+
+    coco_dirs = [os.path.join(shard_dir(args.output, index), COCO_DIR) for index in range(args.shards)]
+    images, annotations = merge_coco(coco_dirs, os.path.join(args.output, COCO_DIR))
+    print(f"Merged {images} images and {annotations} annotations of {args.shards} shards into "
+          f"{os.path.join(args.output, COCO_DIR)}")
+
+
+if __name__ == "__main__":
+    main()
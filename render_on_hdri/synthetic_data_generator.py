@@ -9,6 +9,14 @@ import glob
 import json
 from colorsys import hsv_to_rgb
 from itertools import product
+import sys
+
+# render_core.py lives in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from render_core import (AssetPool, Checkpoint, CocoStream, LightPool, RenderMonitor, WorldHdri,
+                         filter_annotations_by_category, keyframe_shader_value, principled_material,
+                         shard_work)
+
 random.seed(43)
 
 
@@ -33,27 +41,6 @@ def get_hdr_img_paths_from_haven(data_path: str) -> str:
     return hdr_files
 
 
-# Add this function to filter specific category IDs
-def filter_annotations_by_category(data, valid_category_ids):
-    filtered_data = {
-        'category_id_segmaps': [],
-        'instance_segmaps': [],
-        'instance_attribute_maps': [],
-        'colors': []
-    }
-
-    for idx, (seg_map, instance_map, attrs) in enumerate(zip(data['category_id_segmaps'], data['instance_segmaps'], data['instance_attribute_maps'])):
-        filtered_data['category_id_segmaps'].append(seg_map)
-        filtered_data['instance_segmaps'].append(instance_map)
-
-        # Filter instance attributes by category ID
-        filtered_attrs = [attr for attr in attrs if attr['category_id'] in valid_category_ids]
-        filtered_data['instance_attribute_maps'].append(filtered_attrs)
-
-        # You can also store the colors if needed
-        filtered_data['colors'].append(data['colors'][idx])
-
-    return filtered_data
 
 
 
@@ -64,6 +51,8 @@ def load_config(config_file):
 # Set up argument parser
 parser = argparse.ArgumentParser()
 parser.add_argument('--config', default='config.json', help="Path to the JSON configuration file.")
+parser.add_argument('--resume', action='store_true',
+                    help="Continue an interrupted run from the checkpoint.json in its output directory.")
 args = parser.parse_args()
 
 # Load configuration from JSON
@@ -75,6 +64,8 @@ camera_params = config['camera_params']
 output_dir = config['output_dir']
 haven_path = config['haven_path']
 num_images = config['num_images']
+# Frames keyframed and rendered by one render() call
+frames_per_render = config.get('frames_per_render', 10)
 debug = config['debug']
 hand_occlude_path='/home/student/hw2_cv/render_on_hdri/Hand_LowPoly.obj'
 # Debugging setup
@@ -106,10 +97,30 @@ num_images_per_obj=num_images // (len(tweezers)*len(needle_holders))
 
 poses = 0
 instance_id=0
-all_objects = list(product(needle_holders, tweezers))
+# All of them, or this shard's part when started by render_launcher.py
+all_objects = shard_work(args.config, list(product(needle_holders, tweezers)))
 # load hdris
 hdr_files = get_hdr_img_paths_from_haven(haven_path)
 # print(hdr_files)
+# Meshes, lights and the hand material are created once and reused by every pair
+assets = AssetPool()
+lights = LightPool()
+monitor = RenderMonitor()
+# Progress is saved after every render() call, --resume continues from it
+checkpoint = Checkpoint(os.path.join(output_dir, 'checkpoint.json'))
+resume = checkpoint.load() if args.resume else None
+# Frames are appended to coco_data/annotations.jsonl, coco_annotations.json is built from it at the end.
+# Resuming without a checkpoint starts from the first pair, so the frames already logged are dropped
+keep_images = resume['images'] if resume else (0 if args.resume else None)
+coco = CocoStream(os.path.join(output_dir, 'coco_data'), keep_images=keep_images)
+# Every HDRI is loaded once and swapped into the same world node
+hdri = WorldHdri()
+
+# Rendering settings
+bproc.renderer.set_max_amount_of_samples(100)  # Speed up rendering
+bproc.renderer.set_output_format(enable_transparency=False)
+bproc.renderer.enable_segmentation_output(map_by=["category_id", "instance", "name"])  # Enable segmentation masks
+valid_category_ids = [1, 2]  # Keep only these IDs, excluding occluders or any unwanted IDs
 
 # Ensure a world exists
 if bpy.context.scene.world is None:
@@ -128,7 +139,7 @@ if world is not None:
         # Attempt to set the HDR image
         try:
             random_hdr_file = random.choice(hdr_files)
-            bproc.world.set_world_background_hdr_img(random_hdr_file)
+            hdri.set(random_hdr_file)
             print("HDR image set successfully.")
         except Exception as e:
             print(f"Error setting HDR image: {e}")
@@ -136,27 +147,31 @@ else:
     print("Error: No world found.")
 
 
-for obj_paths in all_objects:
-    for obj_x in bpy.context.scene.objects:
-        if obj_x.type == 'MESH':
-            bpy.data.objects.remove(obj_x, do_unlink=True)
-    # This will remove all objects from the scene
-    needle_obj = bproc.loader.load_obj(obj_paths[0])[0]
+for pair_index, obj_paths in enumerate(all_objects):
+    # Pairs finished before the checkpoint
+    if resume is not None and pair_index < resume['pair']:
+        continue
+    if resume is not None:
+        poses, instance_id = resume['poses'], resume['instance_id']
+    pair_instance_id = instance_id
+    # Hide the objects of the previous pair, they stay loaded for reuse
+    assets.release_all()
+    needle_obj = assets.acquire(obj_paths[0])
     needle_obj.set_location([2, 0, 0])
 
     # obj.set_rotation_euler([np.pi/2, 0, 0])
-    tweezers_obj = bproc.loader.load_obj(obj_paths[1])[0]
+    tweezers_obj = assets.acquire(obj_paths[1])
     tweezers_obj.set_location([-2, 0, 0])
 
     #if random.random()<0.6:
-    hand_obj_needle = bproc.loader.load_obj(hand_occlude_path)[0]
+    hand_obj_needle = assets.acquire(hand_occlude_path)
     hand_obj_needle.set_cp("category_id", 10)
     new_scale=hand_obj_needle.get_scale() * 4
     new_scale[1]=-new_scale[1]
     hand_obj_needle.set_scale(new_scale)
     hand_obj_needle.set_location(
         needle_obj.get_location() + np.array([0.5, -0.2, -1.2]))
-    hand_obj_tweezers = bproc.loader.load_obj(hand_occlude_path)[0]
+    hand_obj_tweezers = assets.acquire(hand_occlude_path)
     hand_obj_tweezers.set_cp("category_id", 10)
     new_scale = hand_obj_tweezers.get_scale() * 4
     new_scale[1] = -new_scale[1]
@@ -173,12 +188,15 @@ for obj_paths in all_objects:
     # hand_obj_tweezers.set_rotation_euler(new_rotation_hand_tweezers)
     # hand_obj.set_location(obj.get_location() + np.random.uniform([-0.4, -0.4, -0.4], [0.4, 0.4, 0.4])+np.array([0,0,-1.2]))
     # Darken hand_obj material
-    hand_material = bproc.material.create(name="hand_material")
-    #hand_material.set_principled_shader_value("Base Color", (0.1, 0.1, 0.1, 1.0))  # Dark gray color
-    # hand_material.set_principled_shader_value("Base Color", (0.3, 0.25, 0.2, 1.0))  # Darkest beige
-    hand_material.set_principled_shader_value("Base Color", (0.2, 0.18, 0.16, 1.0))  # Dark gray-beige
-    hand_material.set_principled_shader_value("Specular", 0.1)  # Low specular for a matte finish
-    hand_material.set_principled_shader_value("Roughness", 0.8)  # High roughness for less shine
+    # Created once, later pairs reuse it
+    # Base_Color=(0.1, 0.1, 0.1, 1.0)  # Dark gray color
+    # Base_Color=(0.3, 0.25, 0.2, 1.0)  # Darkest beige
+    hand_material = principled_material(
+        "hand_material",
+        Base_Color=(0.2, 0.18, 0.16, 1.0),  # Dark gray-beige
+        Specular=0.1,  # Low specular for a matte finish
+        Roughness=0.8  # High roughness for less shine
+    )
     hand_obj_needle.replace_materials(hand_material)
     hand_obj_tweezers.replace_materials(hand_material)
 
@@ -208,31 +226,47 @@ for obj_paths in all_objects:
     tweezers_obj.set_cp("instance_id", instance_id + 1)
     instance_id+=1
     initial_poses = poses
+    batch_start = poses
 
     #row down??????
     bproc.utility.reset_keyframes()
+    # Rotations are tracked here, the objects' own values are overwritten by their keyframes when rendering
+    tweezers_rotation = tweezers_obj.get_rotation_euler()
+    needle_rotation = needle_obj.get_rotation_euler()
+    if resume is not None:
+        # Continue the pair from the frame after the checkpoint, with the random state it had there
+        poses = initial_poses + resume['pair_poses']
+        batch_start = poses
+        tweezers_rotation, needle_rotation = resume['tweezers_rotation'], resume['needle_rotation']
+        Checkpoint.restore_random_state(resume)
+        resume = None
     while poses - initial_poses < num_images_per_obj:
-        tweezers_current_rotation = tweezers_obj.get_rotation_euler()
+        # Frames are keyframed and rendered `frames_per_render` at a time
+        frame = poses - batch_start
+        if frame == 0:
+            hdri.start_batch()
+            # One light for the batch, its location and energy are keyframed per frame
+            lights.release_all()
+            light = lights.acquire("POINT")
+
+        tweezers_current_rotation = tweezers_rotation
         tweezers_norm = np.random.normal(0, 0.2)
         tweezers_new_rotation = [tweezers_current_rotation[0], tweezers_current_rotation[1] + tweezers_norm,
                         tweezers_current_rotation[2]]
-        tweezers_obj.set_rotation_euler(tweezers_new_rotation)
+        tweezers_obj.set_rotation_euler(tweezers_new_rotation, frame=frame)
 
-        needle_current_rotation = needle_obj.get_rotation_euler()
+        needle_current_rotation = needle_rotation
         needle_norm = np.random.normal(0, 0.2)
         needle_new_rotation = [needle_current_rotation[0], needle_current_rotation[1] + needle_norm,
                         needle_current_rotation[2]]
-        needle_obj.set_rotation_euler(needle_new_rotation)
+        needle_obj.set_rotation_euler(needle_new_rotation, frame=frame)
 
         #######added#############
         world = bpy.context.scene.world
         random_hdr_file = random.choice(hdr_files)
-        bproc.world.set_world_background_hdr_img(random_hdr_file)
+        hdri.keyframe(random_hdr_file, frame)
         ############################
 
-        light = bproc.types.Light()
-        light.set_type("POINT")
-
         for mat in tweezers_obj.get_materials():
             # Randomly perturbate the material properties
             #mat.set_principled_shader_value("Specular", random.uniform(0.0, 1.0))
@@ -240,17 +274,17 @@ for obj_paths in all_objects:
             # Set a random dark gray base color for the tweezers
             color_tweezers = random.uniform(0.02, 0.08)  # Random value for red channel
 
-            mat.set_principled_shader_value("Base Color", (color_tweezers,color_tweezers,color_tweezers,1.0))
+            keyframe_shader_value(mat, "Base Color", (color_tweezers,color_tweezers,color_tweezers,1.0), frame)
 
-            mat.set_principled_shader_value("Roughness", random.uniform(0.5, 1.0))
-            mat.set_principled_shader_value("Metallic", random.uniform(0.0, 0.5))
+            keyframe_shader_value(mat, "Roughness", random.uniform(0.5, 1.0), frame)
+            keyframe_shader_value(mat, "Metallic", random.uniform(0.0, 0.5), frame)
 
         for mat in needle_obj.get_materials():
             # than it is needle holder and there are 2 materials - metal and gold
 
-            mat.set_principled_shader_value("Specular", random.uniform(0.25, 0.75))
-            mat.set_principled_shader_value("Roughness", random.uniform(0.0, 0.8))
-            mat.set_principled_shader_value("Metallic", random.uniform(0.5, 1.0))
+            keyframe_shader_value(mat, "Specular", random.uniform(0.25, 0.75), frame)
+            keyframe_shader_value(mat, "Roughness", random.uniform(0.0, 0.8), frame)
+            keyframe_shader_value(mat, "Metallic", random.uniform(0.5, 1.0), frame)
 
         light.set_location(bproc.sampler.shell(
             center=hand_obj_needle.get_location(),
@@ -258,8 +292,8 @@ for obj_paths in all_objects:
             radius_max=3,  # Reduced radius for closer, less intense lighting
             elevation_min=10,  # Start at a higher elevation to simulate surgery light
             elevation_max=30
-        ))
-        light.set_energy(random.uniform(200, 500))  # Lowered energy for a dimmer effect
+        ), frame=frame)
+        light.set_energy(random.uniform(200, 500), frame=frame)  # Lowered energy for a dimmer effect
 
         # Define a fixed look-at point (e.g., the object's location)
         location = np.array([0, -20, 0])  # Camera location
@@ -268,37 +302,34 @@ for obj_paths in all_objects:
             inplane_rot=np.pi*random.uniform(0.75, 1)
         )
         cam2world_matrix = bproc.math.build_transformation_mat(location, rotation_matrix)
-        bproc.camera.add_camera_pose(cam2world_matrix)
+        bproc.camera.add_camera_pose(cam2world_matrix, frame=frame)
 
         # Add camera pose if the selected object is visible
         poses += 1
 
-        # Rendering settings
-        bproc.renderer.set_max_amount_of_samples(100)  # Speed up rendering
-        bproc.renderer.set_output_format(enable_transparency=False)
-        bproc.renderer.enable_segmentation_output(map_by=["category_id", "instance", "name"])  # Enable segmentation masks
+        tweezers_rotation = [tweezers_current_rotation[0], tweezers_current_rotation[1] - tweezers_norm,
+                             tweezers_current_rotation[2]]
+        needle_rotation = [needle_current_rotation[0], needle_current_rotation[1] - needle_norm,
+                           needle_current_rotation[2]]
+
+        # Render once the batch is full or the pair has all its images
+        if poses - batch_start < frames_per_render and poses - initial_poses < num_images_per_obj:
+            continue
 
-        valid_category_ids = [1, 2]  # Keep only these IDs, excluding occluders or any unwanted IDs
         # Render RGB images
         data = bproc.renderer.render()
         # Filter out annotations with unwanted category IDs
         filtered_data = filter_annotations_by_category(data, valid_category_ids)
 
         # Write the filtered data to COCO file
-        bproc.writer.write_coco_annotations(
-            os.path.join(output_dir, 'coco_data'),
-            instance_segmaps=filtered_data["instance_segmaps"],
-            instance_attribute_maps=filtered_data["instance_attribute_maps"],
-            colors=filtered_data["colors"],
-            mask_encoding_format="polygon",
-            append_to_existing_output=True
-        )
+        coco.write(filtered_data)
         bproc.utility.reset_keyframes()
-
-        tweezers_new_rotation = [tweezers_current_rotation[0], tweezers_current_rotation[1] - tweezers_norm,
-                                 tweezers_current_rotation[2]]
-        tweezers_obj.set_rotation_euler(tweezers_new_rotation)
-
-        needle_new_rotation = [needle_current_rotation[0], needle_current_rotation[1] - needle_norm,
-                               needle_current_rotation[2]]
-        needle_obj.set_rotation_euler(needle_new_rotation)
+        monitor.frames_done(poses - batch_start)
+        batch_start = poses
+        checkpoint.save(pair=pair_index, pair_poses=poses - initial_poses, poses=initial_poses,
+                        instance_id=pair_instance_id, images=coco.log.next_image_id,
+                        tweezers_rotation=[float(value) for value in tweezers_rotation],
+                        needle_rotation=[float(value) for value in needle_rotation])
+
+coco.close()
+monitor.report()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Pack many small images into a few large shard files read back through memory mapping.
+
+A shard directory holds `index.json` and fixed-size `shard_NNNNN.bin` files. Every record has a key
+(the original file name) and one or more named arrays: `image`, optionally `mask` and `label` (the
+bytes of a YOLO label file). Arrays are stored decoded as L, RGB or RGBA (other modes, e.g. palette
+or 16-bit PNGs, are converted when packing), so reading one is a view into the memory map with no
+file open and no PNG decode. With compression they are zlib compressed at a low level and
+decompressed on read instead.
+"""
+
+import argparse
+import json
+import os
+import zlib
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+INDEX_NAME = 'index.json'
+ALIGNMENT = 64
+
+
+def is_shard_dir(path):
+    return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+
+class ShardWriter:
+    """Appends records to shards of about `shard_bytes` each and writes the index on close.
+
+    :param compression: None to store raw arrays, or 'zlib'.
+    :param level: zlib compression level, low levels are fast to decode.
+    """
+
+    def __init__(self, path, shard_bytes=1024 ** 3, compression=None, level=1):
+        if compression not in (None, 'zlib'):
+            raise ValueError(f"Unknown compression '{compression}', expected None or 'zlib'")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_bytes = shard_bytes
+        self.compression = compression
+        self.level = level
+        self.shards = []
+        self.records = {}
+        self._file = None
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = f"shard_{len(self.shards):05d}.bin"
+        self.shards.append(name)
+        self._file = open(os.path.join(self.path, name), 'wb')
+
+    def add(self, key, **arrays):
+        """Store the named arrays of one record under `key`."""
+        if key in self.records:
+            raise KeyError(f"Duplicate key {key}")
+        if self._file is None or self._file.tell() >= self.shard_bytes:
+            self._next_shard()
+        entry = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            data = array.data.cast('B')
+            if self.compression == 'zlib':
+                data = zlib.compress(data, self.level)
+            # Aligned offsets keep the views into the memory map aligned for any dtype
+            offset = self._file.tell()
+            padding = -offset % ALIGNMENT
+            self._file.write(b'\0' * padding)
+            self._file.write(data)
+            entry[name] = [len(self.shards) - 1, offset + padding, len(data), list(array.shape), array.dtype.str]
+        self.records[key] = entry
+
+    def close(self):
+        if self._file is None and not self.shards:
+            self._next_shard()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = {'version': 1, 'compression': self.compression, 'shards': self.shards, 'records': self.records}
+        # Written last and atomically, a directory without an index is an unfinished pack
+        with open(os.path.join(self.path, INDEX_NAME + '.partial'), 'w') as file:
+            json.dump(index, file)
+        os.replace(os.path.join(self.path, INDEX_NAME + '.partial'), os.path.join(self.path, INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardReader:
+    """Random access to the records of a shard directory. Shards are memory mapped on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'r') as file:
+            index = json.load(file)
+        self.compression = index['compression']
+        self.shards = index['shards']
+        self.records = index['records']
+        self.keys = list(self.records)
+        self._maps = [None] * len(self.shards)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def _map(self, shard):
+        if self._maps[shard] is None:
+            shard_path = os.path.join(self.path, self.shards[shard])
+            # np.memmap cannot map an empty file
+            if os.path.getsize(shard_path) == 0:
+                self._maps[shard] = np.zeros(0, dtype=np.uint8)
+            else:
+                self._maps[shard] = np.memmap(shard_path, dtype=np.uint8, mode='r')
+        return self._maps[shard]
+
+    def get(self, key, name='image'):
+        """Return array `name` of record `key`, a read-only view into the shard when not compressed."""
+        shard, offset, nbytes, shape, dtype = self.records[key][name]
+        data = self._map(shard)[offset:offset + nbytes]
+        if self.compression == 'zlib':
+            data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+        return data.view(np.dtype(dtype)).reshape(shape)
+
+    def names(self, key):
+        """Names of the arrays stored for `key`."""
+        return list(self.records[key])
+
+    def image(self, key, name='image'):
+        """Array `name` of record `key` as a PIL image, sharing memory with the shard where possible."""
+        return Image.fromarray(self.get(key, name))
+
+
+@lru_cache(maxsize=None)
+def open_shards(path):
+    """ShardReader of `path`, opened once per process."""
+    return ShardReader(path)
+
+
+def split_shard_path(path):
+    """Return (shard directory, key) if `path` names a record of a shard directory, else None."""
+    directory, key = os.path.split(path)
+    if directory and is_shard_dir(directory) and key in open_shards(directory):
+        return directory, key
+    return None
+
+
+def _matching_file(directory, stem, suffixes, types):
+    for suffix in suffixes:
+        for ext in types:
+            path = os.path.join(directory, stem + suffix + ext)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def _decoded(path):
+    """Pixels of the image at `path` as an L, RGB or RGBA array, the layouts readers of a shard expect."""
+    image = Image.open(path)
+    if image.mode == '1' or image.mode.startswith(('I', 'F')):
+        image = image.convert('L')
+    elif image.mode in ('LA', 'PA', 'RGBa') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+    elif image.mode not in ('L', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def pack_directory(images, output, masks=None, labels=None, types=('.jpg', '.jpeg', '.png'),
+                   shard_bytes=1024 ** 3, compression=None):
+    """Pack every image of `images` with its mask and label file, matched by file name.
+
+    :param masks: directory of masks named like the image, or with a `_masked` suffix.
+    :param labels: directory of YOLO label files named like the image.
+    :return: number of packed records.
+    """
+    file_names = sorted(p for p in os.listdir(images) if p.lower().endswith(tuple(types)))
+    with ShardWriter(output, shard_bytes=shard_bytes, compression=compression) as writer:
+        for file_name in tqdm(file_names):
+            stem = os.path.splitext(file_name)[0]
+            arrays = {'image': _decoded(os.path.join(images, file_name))}
+            mask_path = masks and _matching_file(masks, stem, ('', '_masked'), types)
+            if mask_path:
+                arrays['mask'] = _decoded(mask_path)
+            label_path = labels and os.path.join(labels, stem + '.txt')
+            if label_path and os.path.exists(label_path):
+                with open(label_path, 'rb') as file:
+                    arrays['label'] = np.frombuffer(file.read(), dtype=np.uint8)
+            writer.add(file_name, **arrays)
+    return len(file_names)
+
+
+def main():
+    # Get and parse all given arguments
+    parser = argparse.ArgumentParser(description="Pack a directory of images into memory-mapped shards.")
+    parser.add_argument("images", type=str, help="Directory of images, e.g. rendered tools or backgrounds.")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output shard directory.")
+    parser.add_argument("--masks", type=str, help="Directory of masks, named like the images or with '_masked'.")
+    parser.add_argument("--labels", type=str, help="Directory of YOLO label files named like the images.")
+    parser.add_argument("--shard-mb", default=1024, type=int, help="Size of one shard in MB. Default: 1024.")
+    parser.add_argument("--compress", action="store_true", help="Store zlib compressed arrays. Default: raw.")
+    args = parser.parse_args()
+
+    count = pack_directory(args.images, args.output, masks=args.masks, labels=args.labels,
+                           shard_bytes=args.shard_mb * 1024 ** 2, compression='zlib' if args.compress else None)
+    print(f"Packed {count} images into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
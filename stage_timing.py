@@ -0,0 +1,89 @@
+"""Per-stage timing of the prediction code, collected only while benchmark.py installs a timer.
+
+predict.py, video.py and overlay.py wrap their decode, inference, mask processing, overlay and
+encode steps in `stage(name)`. Without an installed timer that is a no-op, so the benchmark
+measures the code paths the scripts run (batching, the threaded pipeline, keyframes, ROI mode)
+instead of a copy of them.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+STAGES = ('decode', 'inference', 'tracking', 'mask_processing', 'overlay', 'encode')
+
+_timer = None
+
+
+class StageTimer:
+    """Collects the time spent in each stage and the latency of every frame.
+
+    Stages run on several threads at once in batched and pipelined mode, so the time per stage is
+    busy time summed over threads. The latency of a frame runs from the start of its decode to the
+    end of its encode; frames are matched in the order they were decoded.
+    """
+
+    def __init__(self):
+        self.busy = dict.fromkeys(STAGES, 0.0)
+        self.frames = 0
+        self.latencies = []
+        self._decoded = deque()
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, frames=1):
+        with self._lock:
+            self.busy[name] += end - start
+            if name == STAGES[0]:
+                self._decoded.extend([start] * frames)
+            elif name == STAGES[-1]:
+                self.frames += frames
+                for _ in range(frames):
+                    self.latencies.append(end - (self._decoded.popleft() if self._decoded else start))
+
+    def summary(self, wall_time):
+        latencies = np.array(self.latencies) * 1000
+        count = self.frames
+        return {
+            'frames': count,
+            'wall_time_s': wall_time,
+            'fps': count / wall_time if wall_time > 0 else 0.0,
+            'latency_ms': {
+                'mean': float(latencies.mean()) if count else 0.0,
+                'p50': float(np.percentile(latencies, 50)) if count else 0.0,
+                'p95': float(np.percentile(latencies, 95)) if count else 0.0,
+                'p99': float(np.percentile(latencies, 99)) if count else 0.0,
+            },
+            'stages_ms_per_frame': {name: self.busy[name] * 1000 / count if count else 0.0 for name in STAGES},
+        }
+
+
+class stage:
+    """Context manager timing one step of `frames` frames. Set `frames` to 0 inside it to discard
+    a step that produced no frame, e.g. the read at the end of a video."""
+
+    def __init__(self, name, frames=1):
+        self.name = name
+        self.frames = frames
+
+    def __enter__(self):
+        self._start = time.perf_counter() if _timer is not None else None
+        return self
+
+    def __exit__(self, *exc):
+        timer = _timer
+        if timer is not None and self._start is not None and self.frames:
+            timer.add(self.name, self._start, time.perf_counter(), self.frames)
+
+
+@contextmanager
+def collect():
+    """Install a new StageTimer for the duration of the block and yield it."""
+    global _timer
+    previous, _timer = _timer, StageTimer()
+    try:
+        yield _timer
+    finally:
+        _timer = previous
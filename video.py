@@ -1,79 +1,120 @@
 import cv2
-from ultralytics import YOLO
-import numpy as np
+from model_cache import get_model
+from overlay import draw_results, draw_instances
+from keyframes import Detections, KeyframeScheduler
+from detections_io import DetectionWriter
+from pipeline import run_pipeline, print_stage_report
+from stage_timing import stage
 import os
 
-def process_video(input_video_path, output_video_path, model_path, conf=0.1):
-    # Load the model
-    model = YOLO(model_path)
-
-    # Define colors for each category (in BGR format)
-    colors = {
-        'Tweezers': (0, 255, 0),   # Green
-        'Needle_driver': (0, 0, 255)  # Red
-    }
-
-    # Open the video file
-    cap = cv2.VideoCapture(input_video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    # Define the codec and create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height))
-
+def read_batches(cap, batch_size):
+    # Collect `batch_size` frames before handing them to the model together
+    batch = []
     while cap.isOpened():
-        ret, frame = cap.read()
+        with stage('decode') as timed:
+            ret, frame = cap.read()
+            if not ret:
+                timed.frames = 0
         if not ret:
             break
 
-        # Perform segmentation on the frame
-        results = model(frame, conf=conf)
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
 
-        # Process results
-        for result in results:
-            masks = result.masks
-            boxes = result.boxes
+    # Hand over the last, possibly partial, batch
+    if batch:
+        yield batch
 
-            if masks is not None:
-                for i in range(len(masks)):
-                    mask = masks.data[i].cpu().numpy().astype(bool)
-                    class_id = int(boxes[i].cls)
-                    confidence = boxes[i].conf
-                    category = model.names[class_id]
+def write_results(out, frames, results, names, roi=False, writer=None):
+    # Results come back in the order of the input frames
+    for frame, result in zip(frames, results):
+        # Save the detections of the frame alongside the video
+        if writer is not None:
+            with stage('mask_processing'):
+                detections = Detections.from_result(result, frame.shape)
+            writer.write(detections)
 
-                    # Resize the mask to match the frame dimensions
-                    resized_mask = cv2.resize(mask.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST)
-                    resized_mask = resized_mask.astype(bool)
+        # Draw the masks, boxes and labels of all instances
+        frame = draw_results(frame, [result], names, roi=roi)
 
-                    # Create a color mask with the same shape as the frame
-                    color_mask = np.zeros_like(frame)
-                    color_mask[resized_mask] = colors.get(category, (255, 255, 255))
-
-                    # Combine the color mask with the original frame
-                    frame = cv2.addWeighted(frame, 1, color_mask, 0.5, 0)
-
-                    # Get the bounding box coordinates for placing the label
-                    box = boxes[i].xyxy.cpu().numpy()[0]
-                    x1, y1, x2, y2 = map(int, box)
+        # Write the processed frame to the output video
+        with stage('encode'):
+            out.write(frame)
 
-                    # Draw the bounding box on the frame
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), colors.get(category, (255, 255, 255)), 2)
+def process_video(input_video_path, output_video_path, model_path, conf=0.1, batch_size=1,
+                  pipelined=False, queue_size=4, registry=None, roi=False, keyframes=None,
+                  detections_path=None, backend='pytorch'):
+    # Keyframes are decided frame by frame, so they run without batching or the threaded pipeline
+    if keyframes is not None and (batch_size != 1 or pipelined):
+        raise ValueError("keyframes cannot be combined with batch_size > 1 or pipelined")
 
-                    # Prepare label with category and confidence score
-                    label = f"{category} {confidence.item():.2f}"
+    # Load the model, or reuse it if this process already loaded it
+    model = get_model(model_path, registry=registry, backend=backend)
 
-                    # Draw the label with confidence score on the frame
-                    cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, colors.get(category, (255, 255, 255)), 2)
+    # Open the video file
+    cap = cv2.VideoCapture(input_video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-        # Write the processed frame to the output video
-        out.write(frame)
+    # Define the codec and create VideoWriter object
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height))
 
-    # Release resources
-    cap.release()
-    out.release()
-    cv2.destroyAllWindows()
+    # Stream the per-frame detections to a chunked file if requested
+    writer = DetectionWriter(detections_path, frame_shape=(height, width)) if detections_path else None
+
+    def infer(frames):
+        with stage('inference', len(frames)):
+            return model(frames, conf=conf)
+
+    try:
+        if keyframes is not None:
+            # Run the model only on keyframes and move the last detections on the frames in between
+            for frames in read_batches(cap, 1):
+                frame = frames[0]
+                with stage('tracking'):
+                    detections = keyframes.propagate(frame)
+                if detections is None:
+                    with stage('inference'):
+                        results = model(frame, conf=conf)
+                    with stage('mask_processing'):
+                        detections = Detections.from_result(results[0], frame.shape)
+                    with stage('tracking'):
+                        keyframes.set_keyframe(frame, detections)
+                if writer is not None:
+                    writer.write(detections)
+
+                # Draw the masks, boxes and labels of all instances
+                frame = draw_instances(frame, detections.masks, detections.class_ids, detections.confidences,
+                                       detections.boxes, model.names, roi=roi)
+
+                # Write the processed frame to the output video
+                with stage('encode'):
+                    out.write(frame)
+            keyframes.report()
+        elif pipelined:
+            # Decode, segment and draw/encode on separate threads connected by bounded queues
+            stats, wall_time = run_pipeline(
+                ('decode', read_batches(cap, batch_size)),
+                [('infer', lambda frames: (frames, infer(frames))),
+                 ('encode', lambda batch: write_results(out, batch[0], batch[1], model.names, roi, writer))],
+                queue_size=queue_size)
+            print_stage_report(stats, wall_time)
+        else:
+            for frames in read_batches(cap, batch_size):
+                # Perform segmentation on all frames of the batch in a single call
+                results = infer(frames)
+                write_results(out, frames, results, model.names, roi, writer)
+    finally:
+        # Release resources
+        if writer is not None:
+            writer.close()
+        cap.release()
+        out.release()
+        cv2.destroyAllWindows()
 
 def main():
     # Define paths
@@ -83,9 +124,18 @@ def main():
     input_video_path = 'shorter_test_video.mp4' #replace with the video path from your environment
     output_video_path = os.path.join(output_dir, 'test2_output_video_20_epochs_fine_tune_backgrounds.mp4')
     model_path = 'yolov8_20_epochs_fine_tune.pt' #load model
+    backend = 'pytorch' #'onnx' or 'openvino' export the model once and run it on an optimized CPU runtime
+    batch_size = 1 #number of frames sent to the model in one call (e.g. 8 on a GPU)
+    pipelined = False #decode, segment and encode on separate threads
+    roi = False #upsample and blend masks only inside their boxes (faster on high resolution videos)
+    use_keyframes = False #run the model only on keyframes and track the detections in between
+    detections_path = None #set to a file path to also save the per-frame detections (read them with DetectionReader)
 
     # Process video
-    process_video(input_video_path, output_video_path, model_path)
+    keyframes = KeyframeScheduler() if use_keyframes else None
+    process_video(input_video_path, output_video_path, model_path, batch_size=batch_size, pipelined=pipelined,
+                  roi=roi, keyframes=keyframes, detections_path=detections_path,
+                  backend=backend)
 
 if __name__ == "__main__":
     main()